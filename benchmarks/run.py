@@ -0,0 +1,263 @@
+"""
+Benchmarks for sqlite-transform against synthetic databases.
+
+    python benchmarks/run.py --rows 10000 --rows 1000000 -o results.json
+    python benchmarks/run.py --rows 10000 --compare results.json
+
+Each benchmark runs the sqlite-transform CLI in a separate process against a
+fresh copy of a generated database, recording rows/second, peak RSS of that
+process and the peak size of the rollback journal or WAL file. Timings include
+interpreter startup, so use larger row counts to measure throughput.
+
+This uses os.wait4() so only runs on Unix-like systems.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS = {
+    "parsedate": ["parsedate", "dt"],
+    "parsedatetime": ["parsedatetime", "dt"],
+    "jsonsplit": ["jsonsplit", "tags"],
+    "lambda": ["lambda", "name", "--code", "value.upper()"],
+    "lambda-multi": [
+        "lambda",
+        "location",
+        "--multi",
+        "--code",
+        'dict(zip(("latitude", "longitude"), map(float, value.split(",")))) '
+        "if value else None",
+    ],
+}
+
+DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%m/%d/%Y %I:%M:%S %p",
+    "%d %B %Y",
+    "%b %d, %Y",
+)
+TAGS = ["tag{}".format(i) for i in range(200)]
+
+
+def generate(path, rows, null_ratio, empty_ratio, cardinality, seed):
+    "Create a database with an example table containing rows synthetic rows"
+    rnd = random.Random(seed)
+    start = datetime.datetime(2000, 1, 1)
+
+    def date():
+        value = start + datetime.timedelta(seconds=rnd.randint(0, 20 * 365 * 86400))
+        return value.strftime(rnd.choice(DATE_FORMATS))
+
+    def tags():
+        return ",".join(rnd.sample(TAGS, rnd.randint(1, 5)))
+
+    def location():
+        return "{:.5f},{:.5f}".format(rnd.uniform(-90, 90), rnd.uniform(-180, 180))
+
+    def name():
+        return "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz ") for _ in range(20))
+
+    makers = {"dt": date, "tags": tags, "location": location, "name": name}
+    if cardinality:
+        # Draw every value from a fixed pool of distinct values
+        pools = {
+            column: [maker() for _ in range(cardinality)]
+            for column, maker in makers.items()
+        }
+        makers = {
+            column: (lambda pool=pool: rnd.choice(pool))
+            for column, pool in pools.items()
+        }
+
+    def value(maker):
+        r = rnd.random()
+        if r < null_ratio:
+            return None
+        if r < null_ratio + empty_ratio:
+            return ""
+        return maker()
+
+    def generate_rows():
+        for id in range(1, rows + 1):
+            yield [id] + [value(makers[column]) for column in sorted(makers)]
+
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "create table example (id integer primary key, dt text, location text, "
+        "name text, tags text)"
+    )
+    with conn:
+        conn.executemany(
+            "insert into example (id, dt, location, name, tags) "
+            "values (?, ?, ?, ?, ?)",
+            generate_rows(),
+        )
+    conn.close()
+
+
+def run_benchmark(template, args, extra, workdir):
+    db_path = os.path.join(workdir, "benchmark.db")
+    shutil.copy(template, db_path)
+    rows = sqlite3.connect(db_path).execute("select count(*) from example").fetchone()
+    command, column_args = args[0], args[1:]
+    cmd = (
+        [
+            sys.executable,
+            "-c",
+            "from sqlite_transform.cli import cli; cli()",
+            command,
+            db_path,
+            "example",
+        ]
+        + column_args
+        + ["--silent"]
+        + extra
+    )
+    size_before = os.path.getsize(db_path)
+    peak_journal = {"size": 0}
+    done = threading.Event()
+
+    def watch_journal():
+        while not done.is_set():
+            for suffix in ("-journal", "-wal"):
+                try:
+                    size = os.path.getsize(db_path + suffix)
+                except OSError:
+                    continue
+                peak_journal["size"] = max(peak_journal["size"], size)
+            time.sleep(0.01)
+
+    watcher = threading.Thread(target=watch_journal)
+    watcher.start()
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    done.set()
+    watcher.join()
+    stderr = process.stderr.read().decode("utf-8")
+    process.stderr.close()
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        raise RuntimeError("{} failed:\n{}".format(" ".join(cmd), stderr))
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {
+        "rows": rows[0],
+        "seconds": elapsed,
+        "rows_per_second": rows[0] / elapsed,
+        "peak_rss_bytes": peak_rss,
+        "peak_journal_bytes": peak_journal["size"],
+        "db_growth_bytes": os.path.getsize(db_path) - size_before,
+    }
+
+
+def compare(results, baseline):
+    previous = {
+        (result["benchmark"], result["rows"]): result for result in baseline["results"]
+    }
+    for result in results:
+        old = previous.get((result["benchmark"], result["rows"]))
+        if old is None:
+            continue
+        print(
+            "{:<15} {:>10} rows: {:>6.2f}x rows/sec, {:>6.2f}x peak RSS".format(
+                result["benchmark"],
+                result["rows"],
+                result["rows_per_second"] / old["rows_per_second"],
+                result["peak_rss_bytes"] / old["peak_rss_bytes"],
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--rows",
+        type=int,
+        action="append",
+        help="Number of rows to generate, can be used multiple times",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="append",
+        choices=sorted(BENCHMARKS),
+        help="Benchmarks to run, defaults to all of them",
+    )
+    parser.add_argument("--null-ratio", type=float, default=0.1)
+    parser.add_argument("--empty-ratio", type=float, default=0.05)
+    parser.add_argument(
+        "--cardinality",
+        type=int,
+        help="Number of distinct values per column, defaults to mostly unique",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--extra",
+        default="",
+        help="Extra options to pass to every command, e.g. '--workers 4'",
+    )
+    parser.add_argument("-o", "--output", help="Save results to this JSON file")
+    parser.add_argument("--compare", help="Compare against a previous results file")
+    options = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for rows in options.rows or [10000]:
+            template = os.path.join(workdir, "template-{}.db".format(rows))
+            generate(
+                template,
+                rows,
+                options.null_ratio,
+                options.empty_ratio,
+                options.cardinality,
+                options.seed,
+            )
+            for name in options.benchmark or sorted(BENCHMARKS):
+                result = run_benchmark(
+                    template, BENCHMARKS[name], shlex.split(options.extra), workdir
+                )
+                result["benchmark"] = name
+                results.append(result)
+                print(
+                    "{:<15} {:>10} rows: {:>12,.0f} rows/sec, "
+                    "{:>6.1f}MB peak RSS, {:>8.1f}MB peak journal".format(
+                        name,
+                        rows,
+                        result["rows_per_second"],
+                        result["peak_rss_bytes"] / 1024 / 1024,
+                        result["peak_journal_bytes"] / 1024 / 1024,
+                    )
+                )
+    report = {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "options": {
+            key: value
+            for key, value in vars(options).items()
+            if key not in ("output", "compare")
+        },
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    if options.compare:
+        with open(options.compare) as fp:
+            compare(results, json.load(fp))
+
+
+if __name__ == "__main__":
+    main()
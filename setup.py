@@ -27,6 +27,6 @@ setup(
         sqlite-transform=sqlite_transform.cli:cli
     """,
     install_requires=["dateutils", "tqdm", "click", "sqlite-utils"],
-    extras_require={"test": ["pytest"]},
+    extras_require={"test": ["pytest"], "yaml": ["PyYAML"]},
     tests_require=["sqlite-transform[test]"],
 )
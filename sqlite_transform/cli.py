@@ -1,15 +1,168 @@
 import click
-from dateutil import parser
+import collections
+import contextlib
+import datetime
+import functools
+import heapq
 import json
 import sqlite3
-import sqlite_utils
-import tqdm
+import time
+
+# Heavier modules such as sqlite_utils, dateutil, tqdm, asyncio and
+# multiprocessing are imported by the functions that use them, as the tool is
+# often run many times from shell loops and this keeps startup fast
 
 sqlite3.enable_callback_tracebacks(True)
 
+ON_ERROR_CHOICES = ("skip", "null", "keep")
+ONLINE_BATCH_SIZE = 1000
+ONLINE_BUSY_TIMEOUT = 1.0
+
 
 def common_options(fn):
     click.option("-s", "--silent", is_flag=True, help="Don't show a progress bar")(fn)
+    click.option(
+        "--duty-cycle",
+        type=click.FloatRange(min=0.01, max=1.0),
+        help="With --online, sleep so as to only be busy for this fraction of the time",
+    )(fn)
+    click.option(
+        "--rate",
+        # min_open needs click 8, so 0 is rejected by _transform()
+        type=click.FloatRange(min=0),
+        help="With --online, transform at most this many rows per second",
+    )(fn)
+    click.option(
+        "--busy-timeout",
+        type=click.FloatRange(min=0),
+        help=(
+            "With --online, seconds to wait for another connection's lock "
+            "before backing off and retrying  [default: {}]".format(ONLINE_BUSY_TIMEOUT)
+        ),
+    )(fn)
+    click.option(
+        "--online",
+        is_flag=True,
+        help="Commit in short transactions, backing off while others are writing",
+    )(fn)
+    click.option(
+        "--errors-table",
+        help=(
+            "Record values that raise an exception in this table, "
+            "implies --on-error skip"
+        ),
+    )(fn)
+    click.option(
+        "--on-error",
+        type=click.Choice(ON_ERROR_CHOICES),
+        help=(
+            "Instead of stopping, skip values that raise an exception, "
+            "set them to null or keep the original value"
+        ),
+    )(fn)
+    click.option(
+        "--estimate-count",
+        is_flag=True,
+        help="Estimate the number of rows instead of counting them, to start faster",
+    )(fn)
+    click.option(
+        "--sample",
+        type=click.IntRange(min=1),
+        help="Dry run that estimates the full run from a sample of N rows",
+    )(fn)
+    click.option(
+        "--dry-run",
+        is_flag=True,
+        help="Show results of running this against the first 10 rows",
+    )(fn)
+    click.option(
+        "--jobs",
+        type=click.IntRange(min=1),
+        default=1,
+        show_default=True,
+        help="Transform this many database files or tables at once",
+    )(fn)
+    click.option(
+        "tables",
+        "--table",
+        multiple=True,
+        help="Also transform the same columns in this table",
+    )(fn)
+    click.option(
+        "dbs",
+        "--db",
+        multiple=True,
+        type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+        help="Also transform this database file",
+    )(fn)
+    click.option(
+        "--progress-json",
+        is_flag=True,
+        help="Write progress to stderr as JSON lines instead of showing a bar",
+    )(fn)
+    click.option(
+        "--stats-json",
+        type=click.Path(file_okay=True, dir_okay=False, allow_dash=True),
+        help="Write timings and counts for the run to this JSON file",
+    )(fn)
+    click.option(
+        "--profile",
+        is_flag=True,
+        help="Show where time was spent and the slowest values afterwards",
+    )(fn)
+    click.option(
+        "--pragma",
+        "pragmas",
+        multiple=True,
+        help="SQLite PRAGMA to use for the run, e.g. synchronous=off",
+    )(fn)
+    click.option(
+        "--fast",
+        is_flag=True,
+        help="Use faster, less crash-safe PRAGMA settings for the run",
+    )(fn)
+    click.option(
+        "--dedupe/--no-dedupe",
+        default=None,
+        help=(
+            "Transform each distinct value once and write back with a join - "
+            "used automatically for low cardinality columns, except by lambda"
+        ),
+    )(fn)
+    click.option(
+        "--workers",
+        type=click.IntRange(min=1),
+        help="Evaluate values in parallel using this many processes",
+    )(fn)
+    click.option(
+        "--batch-time",
+        type=float,
+        help="Adjust --batch-size to aim for this many seconds per commit",
+    )(fn)
+    click.option(
+        "--batch-size",
+        type=click.IntRange(min=1),
+        help="Commit after every N rows, resuming from the last commit if interrupted",
+    )(fn)
+    click.option(
+        "-p",
+        "--param",
+        "params",
+        multiple=True,
+        type=(str, str),
+        help="Named :parameters for the --where clause",
+    )(fn)
+    click.option("--where", help="Only transform rows matching this SQL where clause")(
+        fn
+    )
+    click.option(
+        "--vacuum",
+        is_flag=True,
+        help=(
+            "Reclaim the space used by columns removed with --drop, "
+            "needs auto_vacuum=incremental"
+        ),
+    )(fn)
     click.option("--drop", is_flag=True, help="Drop original column afterwards")(fn)
     click.option(
         "--output-type",
@@ -17,6 +170,11 @@ def common_options(fn):
         default="text",
         type=click.Choice(["integer", "float", "blob", "text"]),
     )(fn)
+    click.option(
+        "--output-db",
+        type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+        help="Write results to a table in this database, leaving DB_PATH unchanged",
+    )(fn)
     click.option(
         "--output", help="Optional separate column to populate with the output"
     )(fn)
@@ -47,24 +205,52 @@ def cli():
     is_flag=True,
     help="Assume year comes first in ambiguous dates, e.g. 03/04/05",
 )
+@click.option(
+    "formats",
+    "--format",
+    multiple=True,
+    help="strptime() format to try before falling back to dateutil, e.g. %Y-%m-%d",
+)
+@click.option(
+    "--sql-pushdown",
+    is_flag=True,
+    help="Transform simple values in SQL, only calling Python for the rest",
+)
 @common_options
-def parsedate(
-    db_path, table, columns, dayfirst, yearfirst, output, output_type, drop, silent
-):
+def parsedate(db_path, table, columns, dayfirst, yearfirst, formats, **kwargs):
     """
     Parse and convert columns to ISO dates
     """
-    _transform(
+    if kwargs["sql_pushdown"]:
+        if dayfirst or formats:
+            raise click.ClickException(
+                "--sql-pushdown cannot be used with --dayfirst or --format"
+            )
+        kwargs["sql_pushdown"] = _parse_date_sql
+    _run(
+        _transform,
         db_path,
         table,
-        columns,
-        lambda v: parser.parse(v, dayfirst=dayfirst, yearfirst=yearfirst)
-        .date()
-        .isoformat(),
-        output,
-        output_type,
-        drop,
-        silent,
+        (
+            columns,
+            functools.partial(
+                _parse_date,
+                dayfirst=dayfirst,
+                yearfirst=yearfirst,
+                # Formats are inferred from the first database only
+                formats=formats
+                or _infer_date_formats(
+                    _db_paths(db_path, kwargs["dbs"])[0],
+                    table,
+                    columns,
+                    dayfirst,
+                    yearfirst,
+                    kwargs["where"],
+                    dict(kwargs["params"]),
+                ),
+            ),
+        ),
+        kwargs,
     )
 
 
@@ -86,22 +272,52 @@ def parsedate(
     is_flag=True,
     help="Assume year comes first in ambiguous dates, e.g. 03/04/05",
 )
+@click.option(
+    "formats",
+    "--format",
+    multiple=True,
+    help="strptime() format to try before falling back to dateutil, e.g. %Y-%m-%d",
+)
+@click.option(
+    "--sql-pushdown",
+    is_flag=True,
+    help="Transform simple values in SQL, only calling Python for the rest",
+)
 @common_options
-def parsedatetime(
-    db_path, table, columns, dayfirst, yearfirst, output, output_type, drop, silent
-):
+def parsedatetime(db_path, table, columns, dayfirst, yearfirst, formats, **kwargs):
     """
     Parse and convert columns to ISO timestamps
     """
-    _transform(
+    if kwargs["sql_pushdown"]:
+        if dayfirst or formats:
+            raise click.ClickException(
+                "--sql-pushdown cannot be used with --dayfirst or --format"
+            )
+        kwargs["sql_pushdown"] = _parse_datetime_sql
+    _run(
+        _transform,
         db_path,
         table,
-        columns,
-        lambda v: parser.parse(v, dayfirst=dayfirst, yearfirst=yearfirst).isoformat(),
-        output,
-        output_type,
-        drop,
-        silent,
+        (
+            columns,
+            functools.partial(
+                _parse_datetime,
+                dayfirst=dayfirst,
+                yearfirst=yearfirst,
+                # Formats are inferred from the first database only
+                formats=formats
+                or _infer_date_formats(
+                    _db_paths(db_path, kwargs["dbs"])[0],
+                    table,
+                    columns,
+                    dayfirst,
+                    yearfirst,
+                    kwargs["where"],
+                    dict(kwargs["params"]),
+                ),
+            ),
+        ),
+        kwargs,
     )
 
 
@@ -119,23 +335,27 @@ def parsedatetime(
     type=click.Choice(("int", "float")),
     help="Type to use for values - int or float (defaults to string)",
 )
+@click.option(
+    "--sql-pushdown",
+    is_flag=True,
+    help="Transform simple values in SQL, only calling Python for the rest",
+)
 @common_options
-def jsonsplit(
-    db_path, table, columns, delimiter, type, output, output_type, drop, silent
-):
+def jsonsplit(db_path, table, columns, delimiter, type, **kwargs):
     """
     Convert columns into JSON arrays by splitting on a delimiter
     """
-    value_convert = lambda s: s.strip()
-    if type == "int":
-        value_convert = lambda s: int(s.strip())
-    elif type == "float":
-        value_convert = lambda s: float(s.strip())
-
-    def convert(value):
-        return json.dumps([value_convert(s) for s in value.split(delimiter)])
-
-    _transform(db_path, table, columns, convert, output, output_type, drop, silent)
+    if kwargs["sql_pushdown"]:
+        kwargs["sql_pushdown"] = functools.partial(
+            _jsonsplit_sql, delimiter=delimiter, type=type
+        )
+    _run(
+        _transform,
+        db_path,
+        table,
+        (columns, functools.partial(_jsonsplit, delimiter=delimiter, type=type)),
+        kwargs,
+    )
 
 
 @cli.command(name="lambda")
@@ -153,10 +373,30 @@ def jsonsplit(
     "--import", "imports", type=str, multiple=True, help="Python modules to import"
 )
 @click.option(
-    "--dry-run", is_flag=True, help="Show results of running this against first 10 rows"
+    "--multi", is_flag=True, help="Populate columns for keys in returned dictionary"
 )
 @click.option(
-    "--multi", is_flag=True, help="Populate columns for keys in returned dictionary"
+    "--row",
+    is_flag=True,
+    help="Code is passed a dictionary called 'row' with all of the columns",
+)
+@click.option(
+    "--batch",
+    is_flag=True,
+    help="Code transforms a list called 'values' and returns a list of results",
+)
+@click.option(
+    "--async",
+    "async_",
+    is_flag=True,
+    help="Code is run as an async function, so it can use await",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=10,
+    show_default=True,
+    help="Number of calls to run at once with --async",
 )
 @common_options
 def lambda_(
@@ -165,12 +405,16 @@ def lambda_(
     columns,
     code,
     imports,
-    dry_run,
     multi,
+    row,
+    batch,
+    async_,
+    concurrency,
     output,
-    output_type,
     drop,
     silent,
+    dedupe,
+    **kwargs
 ):
     """
     Transform columns using Python code you supply. For example:
@@ -181,104 +425,2432 @@ def lambda_(
         --import=textwrap
 
     "value" is a variable with the column value to be transformed.
+
+    With --batch the code is passed a list called "values" instead, and
+    should return a list of the same length.
+
+    With --async the code can use "await", and up to --concurrency values
+    will be transformed at once.
+
+    With --row the code is passed a dictionary called "row" with the values
+    of every column instead, and its result is saved to --output.
     """
-    if output is not None and len(columns) > 1:
-        raise click.ClickException("Cannot use --output with more than one column")
-    if multi and len(columns) > 1:
-        raise click.ClickException("Cannot use --multi with more than one column")
-    # If single line and no 'return', add the return
-    if "\n" not in code and not code.strip().startswith("return "):
-        code = "return {}".format(code)
-    # Compile the code into a function body called fn(value)
-    new_code = ["def fn(value):"]
-    for line in code.split("\n"):
-        new_code.append("    {}".format(line))
-    code_o = compile("\n".join(new_code), "<string>", "exec")
-    locals = {}
-    globals = {}
-    for import_ in imports:
-        globals[import_] = __import__(import_)
-    exec(code_o, globals, locals)
-    fn = locals["fn"]
-    if dry_run:
-        # Pull first 20 values for first column and preview them
-        db = sqlite3.connect(db_path)
-        db.create_function("preview_transform", 1, lambda v: fn(v) if v else v)
-        sql = """
-            select
-                [{column}] as value,
-                preview_transform([{column}]) as preview
-            from [{table}] limit 10
-        """.format(
-            column=columns[0], table=table
-        )
-        for row in db.execute(sql).fetchall():
-            print(row[0])
-            print(" --- becomes:")
-            print(row[1])
-            print()
-    elif multi:
-        _transform_multi(db_path, table, columns[0], fn, drop, silent)
+    if row:
+        if output is None and len(columns) > 1 and not multi:
+            raise click.ClickException(
+                "--row needs --output when used with more than one column"
+            )
+        if output is not None and multi:
+            raise click.ClickException("Cannot use --output with --row and --multi")
     else:
-        _transform(db_path, table, columns, fn, output, output_type, drop, silent)
+        if output is not None and len(columns) > 1:
+            raise click.ClickException("Cannot use --output with more than one column")
+        if multi and len(columns) > 1:
+            raise click.ClickException("Cannot use --multi with more than one column")
+    if batch and async_:
+        raise click.ClickException("Cannot use --batch with --async")
+    fn = CompiledCode(
+        code,
+        imports,
+        argument="row" if row else "values" if batch else "value",
+        is_async=async_,
+    )
+    if async_:
+        # Run as vectorized code, awaiting each batch of values concurrently
+        fn = AsyncBatch(fn, concurrency)
+        batch = True
+    if multi or row:
+        # Both evaluate the code once per row, then write every column it
+        # sets - --row without --multi sets just the one output column
+        flag = "--multi" if multi else "--row"
+        if batch:
+            raise click.ClickException(
+                "Cannot use --batch or --async with {}".format(flag)
+            )
+        if (
+            dedupe
+            or kwargs["batch_time"]
+            or kwargs["workers"]
+            or kwargs["output_db"]
+            or kwargs["online"]
+        ):
+            raise click.ClickException(
+                "{} cannot be used with --batch-time, --workers, --dedupe, "
+                "--output-db or --online".format(flag)
+            )
+        output_types = None
+        if not multi:
+            fn = functools.partial(_single_output, output or columns[0], fn)
+            output_types = {output or columns[0]: kwargs["output_type"]}
+        _run(
+            _transform_multi,
+            db_path,
+            table,
+            (columns, fn),
+            {
+                "drop": drop,
+                "silent": silent,
+                "row": row,
+                "output_types": output_types,
+                "params": dict(kwargs["params"]),
+                **{
+                    key: kwargs[key]
+                    for key in (
+                        "batch_size",
+                        "profile",
+                        "stats_json",
+                        "progress_json",
+                        "where",
+                        "dbs",
+                        "tables",
+                        "jobs",
+                        "fast",
+                        "pragmas",
+                        "vacuum",
+                        "dry_run",
+                        "sample",
+                        "estimate_count",
+                        "on_error",
+                        "errors_table",
+                    )
+                },
+            },
+        )
+    else:
+        _run(
+            _transform,
+            db_path,
+            table,
+            (columns, fn),
+            dict(
+                kwargs,
+                output=output,
+                drop=drop,
+                silent=silent,
+                # Code may not return the same output for the same input, so
+                # only dedupe if it was explicitly requested
+                dedupe=bool(dedupe),
+                vectorized=batch,
+            ),
+        )
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument(
+    "spec_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=True),
+)
+@common_options
+def run(db_path, spec_path, output, **kwargs):
+    """
+    Run several transforms from a JSON or YAML spec file in a single pass:
+
+    \b
+    $ sqlite-transform run my.db spec.yml
+
+    Where spec.yml looks like this:
+
+    \b
+    table: articles
+    steps:
+    - parsedate: created
+    - jsonsplit: tags
+      type: int
+    - lambda: title
+      code: value.strip()
+    """
+    from .pipeline import Pipeline
+
+    if output is not None:
+        raise click.ClickException("Set output for each step in the spec instead")
+    spec = _load_spec(spec_path)
+    table = spec.get("table") if isinstance(spec, dict) else None
+    if table is None:
+        if not kwargs["tables"]:
+            raise click.ClickException("Spec needs a table, or use --table")
+        table = kwargs["tables"][0]
+    _run(Pipeline.from_spec(spec).run, db_path, table, (), kwargs)
+
+
+def _load_spec(spec_path):
+    with click.open_file(spec_path) as fp:
+        content = fp.read()
+    if not spec_path.endswith((".yml", ".yaml")):
+        try:
+            return json.loads(content)
+        except ValueError as ex:
+            raise click.ClickException("Invalid JSON spec: {}".format(ex))
+    try:
+        import yaml
+    except ImportError:
+        raise click.ClickException(
+            "YAML spec files need PyYAML: pip install sqlite-transform[yaml]"
+        )
+    try:
+        return yaml.safe_load(content)
+    except yaml.YAMLError as ex:
+        raise click.ClickException("Invalid YAML spec: {}".format(ex))
 
 
-def _transform(db_path, table, columns, fn, output, output_type, drop, silent):
+def _parse_date(value, dayfirst=False, yearfirst=False, formats=()):
+    return _parse(value, dayfirst, yearfirst, formats).date().isoformat()
+
+
+def _parse_datetime(value, dayfirst=False, yearfirst=False, formats=()):
+    return _parse(value, dayfirst, yearfirst, formats).isoformat()
+
+
+def _parse(value, dayfirst, yearfirst, formats):
+    # strptime() caches its compiled format, so is much faster than dateutil
+    for format in formats:
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    from dateutil import parser
+
+    return parser.parse(value, dayfirst=dayfirst, yearfirst=yearfirst)
+
+
+# Two digit years are left to dateutil, which pivots them differently to %y
+DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%d %H:%M",
+    "%Y/%m/%d",
+    "%Y/%m/%d %H:%M:%S",
+    "%m/%d/%Y",
+    "%m/%d/%Y %H:%M",
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%Y %I:%M:%S %p",
+    "%d/%m/%Y",
+    "%d/%m/%Y %H:%M",
+    "%d/%m/%Y %H:%M:%S",
+    "%d.%m.%Y",
+    "%d-%m-%Y",
+    "%d %B %Y",
+    "%d %b %Y",
+    "%B %d, %Y",
+    "%b %d, %Y",
+    "%Y%m%d",
+)
+DATE_FORMATS_SAMPLE_SIZE = 1000
+DATE_FORMATS_MAX = 3
+
+
+def _infer_date_formats(
+    db_path, table, columns, dayfirst, yearfirst, where=None, params=None
+):
+    from dateutil import parser
+    import sqlite_utils
+
+    # Find the formats that parse a sample of the values exactly as dateutil
+    # would with these options, most common first
     db = sqlite_utils.Database(db_path)
-    count_sql = "select count(*) from [{}]".format(table)
-    todo_count = list(db.execute(count_sql).fetchall())[0][0] * len(columns)
+    values = []
+    for column in columns:
+        values.extend(
+            row[0]
+            for row in db.execute(
+                "select [{column}] from [{table}] where [{column}] is not null "
+                "and [{column}] != ''{where} limit {limit}".format(
+                    column=column,
+                    table=table,
+                    where=_where_clause(where, " and "),
+                    limit=DATE_FORMATS_SAMPLE_SIZE,
+                ),
+                params or {},
+            ).fetchall()
+            if isinstance(row[0], str)
+        )
+    expected = {}
+    for value in values:
+        try:
+            expected[value] = parser.parse(
+                value, dayfirst=dayfirst, yearfirst=yearfirst
+            )
+        except (ValueError, OverflowError):
+            pass
+    matches = {}
+    for format in DATE_FORMATS:
+        if not _same_day_month_order(format, dayfirst):
+            # Values outside the sample could be ambiguous, e.g. 03/04/2020
+            continue
+        count = 0
+        for value, parsed in expected.items():
+            try:
+                if datetime.datetime.strptime(value, format) != parsed:
+                    count = 0
+                    break
+            except ValueError:
+                continue
+            count += 1
+        if count:
+            matches[format] = count
+    formats = sorted(matches, key=lambda format: -matches[format])
+    return tuple(formats[:DATE_FORMATS_MAX])
+
+
+def _same_day_month_order(format, dayfirst):
+    # dateutil puts the day before the month in numeric dates if and only if
+    # dayfirst is set, even in dates that start with the year
+    if "%d" not in format or "%m" not in format:
+        return True
+    return (format.index("%d") < format.index("%m")) == bool(dayfirst)
+
+
+def _jsonsplit(value, delimiter=",", type=None):
+    value_convert = {"int": int, "float": float}.get(type, str)
+    return json.dumps([value_convert(s.strip()) for s in value.split(delimiter)])
+
+
+# --sql-pushdown expressions evaluate to null for any value they can't
+# transform exactly as Python would, so it can fall back to calling Python
+
+ISO_DATE_GLOB = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"
+ISO_DATE_GLOBS = [ISO_DATE_GLOB] + [
+    ISO_DATE_GLOB + separator + "[0-9][0-9]:[0-9][0-9]" + seconds
+    for separator in (" ", "T")
+    for seconds in ("", ":[0-9][0-9]")
+]
+
+
+def _parse_date_sql(column):
+    return _iso_date_sql(column, "substr(r, 1, 10)")
+
+
+def _parse_datetime_sql(column):
+    return _iso_date_sql(column, "r")
+
+
+def _iso_date_sql(column, result):
+    # Only ISO dates and times, which dateutil parses the same way unless
+    # dayfirst is set. Converting via julianday() normalizes invalid dates
+    # like February 30th, which the comparison then rejects.
+    return (
+        "(case when typeof({c}) = 'text' and ({globs}) and {c} not glob '0000*' "
+        "then (select case when substr(r, 1, 10) = substr({c}, 1, 10) "
+        "and (length({c}) = 10 or substr(r, 12, length({c}) - 11) = substr({c}, 12)) "
+        "then {result} end "
+        "from (select strftime('%Y-%m-%dT%H:%M:%S', julianday({c})) as r)) end)"
+    ).format(
+        c=column,
+        globs=" or ".join(
+            "{} glob '{}'".format(column, glob) for glob in ISO_DATE_GLOBS
+        ),
+        result=result,
+    )
+
+
+def _jsonsplit_sql(column, delimiter=",", type=None):
+    # Limited to printable ASCII, where json_quote() and trim() match what
+    # json.dumps() and str.strip() would do
+    if not delimiter or type == "float":
+        return None
+    delimiter = "'{}'".format(delimiter.replace("'", "''"))
+    piece = "trim(substr(rest, 1, instr(rest, {}) - 1))".format(delimiter)
+    if type == "int":
+        item = "cast({} as integer)".format(piece)
+        valid = (
+            "({piece} glob '[0-9]*' or {piece} glob '-[0-9]*') "
+            "and {piece} not glob '?*[^0-9]*' and length({piece}) <= 18"
+        ).format(piece=piece)
+    else:
+        item = "json_quote({})".format(piece)
+        valid = "1"
+    return (
+        "(case when typeof({c}) = 'text' and {c} != '' and {c} not glob '*[^ -~]*' "
+        "then (with recursive split(items, rest, ok) as ("
+        "select null, {c} || {d}, 1 "
+        "union all select coalesce(items || ', ', '') || {item}, "
+        "substr(rest, instr(rest, {d}) + length({d})), ok and {valid} "
+        "from split where rest != ''"
+        ") select '[' || items || ']' from split where rest = '' and ok) end)"
+    ).format(c=column, d=delimiter, item=item, valid=valid)
+
+
+class CompiledCode:
+    """
+    Code from --code compiled into a function that takes value
+
+    Instances can be pickled, so they can be sent to --workers processes.
+    """
+
+    def __init__(self, code, imports=(), argument="value", is_async=False):
+        self.code = code
+        self.imports = tuple(imports)
+        self.argument = argument
+        self.is_async = is_async
+        # If single line and no 'return', add the return
+        if "\n" not in code and not code.strip().startswith("return "):
+            code = "return {}".format(code)
+        # Compile the code into a function body called fn(value)
+        new_code = ["{}def fn({}):".format("async " if is_async else "", argument)]
+        for line in code.split("\n"):
+            new_code.append("    {}".format(line))
+        code_o = compile("\n".join(new_code), "<string>", "exec")
+        locals = {}
+        globals = {}
+        for import_ in imports:
+            globals[import_] = __import__(import_)
+        exec(code_o, globals, locals)
+        self.fn = locals["fn"]
+
+    def __call__(self, value):
+        return self.fn(value)
+
+    def __getstate__(self):
+        return {
+            "code": self.code,
+            "imports": self.imports,
+            "argument": self.argument,
+            "is_async": self.is_async,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class AsyncBatch:
+    """
+    Turns an async fn(value) into fn(values) that returns a list of results,
+    running up to concurrency calls at once on an event loop
+
+    With catch_errors each value that raises an exception gets a
+    TransformFailed result, without stopping the other calls.
+    """
+
+    def __init__(self, fn, concurrency, catch_errors=False):
+        self.fn = fn
+        self.concurrency = concurrency
+        self.catch_errors = catch_errors
+
+    def __call__(self, values):
+        import asyncio
+
+        # A new loop each time, as asyncio.run() is not available in Python 3.6
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.gather(values))
+        finally:
+            loop.close()
+
+    async def gather(self, values):
+        import asyncio
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def transform(value):
+            async with semaphore:
+                return await self.fn(value)
+
+        # Every call is left to finish, so none are still pending when the
+        # loop is closed
+        results = await asyncio.gather(
+            *(transform(value) for value in values), return_exceptions=True
+        )
+        for i, result in enumerate(results):
+            if isinstance(result, BaseException):
+                if not (self.catch_errors and isinstance(result, Exception)):
+                    raise result
+                results[i] = _failed(result)
+        return results
+
+
+class RunStats:
+    """
+    Counts and timings for a run, reported by --profile and --stats-json
+
+    Individual calls to the transform function are only timed if enabled.
+    """
+
+    SLOWEST = 10
+    # Upper bounds in seconds for the latency histogram
+    BUCKETS = ((0.00001, "<10us"), (0.0001, "<100us"), (0.001, "<1ms"))
+    BUCKETS += ((0.01, "<10ms"), (0.1, "<100ms"), (1.0, "<1s"))
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.counts = collections.Counter()
+        self.timings = collections.Counter()
+        self.histogram = collections.Counter()
+        self.slowest = []
+
+    def wrap(self, fn):
+        "Returns fn wrapped to time and count each call, if enabled"
+        if not self.enabled:
+            return fn
+
+        def timed(value):
+            start = time.perf_counter()
+            try:
+                result = fn(value)
+            except Exception:
+                self.counts["errors"] += 1
+                raise
+            finally:
+                self.record_call(value, time.perf_counter() - start)
+            if result != value:
+                self.counts["changed"] += 1
+            return result
+
+        return timed
+
+    def record_call(self, value, duration):
+        self.counts["calls"] += 1
+        self.timings["fn"] += duration
+        for limit, label in self.BUCKETS:
+            if duration < limit:
+                self.histogram[label] += 1
+                break
+        else:
+            self.histogram[">=1s"] += 1
+        item = (duration, self.counts["calls"], value)
+        if len(self.slowest) < self.SLOWEST:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def record_batch(self, values, results, duration):
+        "Record a batch of values that were transformed out of process"
+        calls = [(value, result) for value, result in zip(values, results) if value]
+        self.counts["calls"] += len(calls)
+        self.counts["changed"] += sum(
+            1
+            for value, result in calls
+            if result != value and not isinstance(result, TransformFailed)
+        )
+        self.timings["fn"] += duration
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        "Time a block, excluding time spent inside the transform function"
+        start = time.perf_counter()
+        fn_before = self.timings["fn"]
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] += elapsed - (self.timings["fn"] - fn_before)
+
+    def report(self):
+        seconds = time.perf_counter() - self.start
+        scanned = self.counts["scanned"]
+        timings = {name: self.timings[name] for name in ("fn", "sql", "commit")}
+        timings.update(self.timings)
+        timings["other"] = max(0.0, seconds - sum(timings.values()))
+        return {
+            "seconds": seconds,
+            "values_scanned": scanned,
+            "values_skipped": scanned - self.counts["calls"] - self.counts["sql"],
+            "values_in_sql": self.counts["sql"],
+            "writes_skipped": self.counts["writes_skipped"],
+            "busy_retries": self.counts["busy"],
+            "fn_calls": self.counts["calls"],
+            "values_changed": self.counts["changed"],
+            "errors": self.counts["errors"],
+            "values_per_second": scanned / seconds if seconds else None,
+            "timings": timings,
+            "latency_histogram": {
+                label: self.histogram[label]
+                for label in [label for _, label in self.BUCKETS] + [">=1s"]
+            },
+            "slowest": [
+                {"value": repr(value)[:100], "seconds": duration}
+                for duration, _, value in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+    def format(self, report):
+        lines = [
+            "Values scanned: {:,}".format(report["values_scanned"]),
+            "Values skipped: {:,}".format(report["values_skipped"]),
+            "Values transformed in SQL: {:,}".format(report["values_in_sql"]),
+            "Writes skipped: {:,} unchanged".format(report["writes_skipped"]),
+            "Function calls: {:,} ({:,} changed, {:,} errors)".format(
+                report["fn_calls"], report["values_changed"], report["errors"]
+            ),
+            "Total time: {:.3f}s ({:,.0f} values/second)".format(
+                report["seconds"], report["values_per_second"] or 0
+            ),
+        ]
+        if report["busy_retries"]:
+            lines.append(
+                "Busy retries: {:,} while locked by another connection".format(
+                    report["busy_retries"]
+                )
+            )
+        for name, seconds in report["timings"].items():
+            lines.append("  {}: {:.3f}s".format(name, seconds))
+        if report["fn_calls"] and self.enabled:
+            lines.append("Function call latency:")
+            for label, count in report["latency_histogram"].items():
+                lines.append("  {:>6}: {:,}".format(label, count))
+        if report["slowest"]:
+            lines.append("Slowest values:")
+            for item in report["slowest"]:
+                lines.append("  {:.6f}s: {}".format(item["seconds"], item["value"]))
+        return "\n".join(lines)
+
+
+class Progress:
+    """
+    Reports progress as a tqdm bar, as JSON lines or not at all
+
+    Code on the per-value path should count locally and call update() with
+    batches of values, as even a disabled tqdm bar has a cost per call.
+    """
+
+    JSON_INTERVAL = 1.0
+
+    def __init__(self, total, silent=False, json_lines=False, desc=None):
+        self.total = total
+        self.desc = desc
+        self.n = 0
+        self.bar = None
+        self.json_lines = json_lines and not silent
+        if not silent and not json_lines:
+            import tqdm
+
+            self.bar = tqdm.tqdm(total=total, desc=desc)
+        self.start = self.last_json = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, n):
+        self.n += n
+        if self.n > self.total:
+            # The total was an estimate
+            self.set_total(self.n)
+        if self.bar is not None:
+            self.bar.update(n)
+        elif self.json_lines and time.perf_counter() - self.last_json >= (
+            self.JSON_INTERVAL
+        ):
+            self.write_json()
+
+    def set_total(self, total):
+        self.total = total
+        if self.bar is not None:
+            self.bar.total = total
+            self.bar.refresh()
+
+    def write_json(self, done=False):
+        now = time.perf_counter()
+        self.last_json = now
+        elapsed = now - self.start
+        line = {
+            "desc": self.desc,
+            "n": self.n,
+            "total": self.total,
+            "elapsed": round(elapsed, 3),
+            "rate": round(self.n / elapsed, 3) if elapsed else None,
+            "done": done,
+        }
+        click.echo(json.dumps(line), err=True)
+
+    def close(self):
+        if self.bar is not None:
+            self.bar.close()
+        elif self.json_lines:
+            self.write_json(done=True)
+
+
+class Throttle:
+    """
+    Paces an --online run so it can share the database with other writers
+
+    Sleeps between batches to stay under --rate rows per second and to only
+    be busy for --duty-cycle of the time, and retries reads and writes with
+    an exponential back-off when another connection has the database locked.
+    A disabled Throttle calls straight through.
+    """
+
+    BACKOFF_START = 0.05
+    BACKOFF_MAX = 5.0
+    MAX_ATTEMPTS = 20
+
+    def __init__(self, enabled=False, rate=None, duty_cycle=None):
+        self.enabled = enabled
+        self.rate = rate
+        self.duty_cycle = duty_cycle
+        self.start = time.perf_counter()
+        self.rows = 0
+
+    def retry(self, fn, stats):
+        "Return fn(), calling it again after a pause if the database is busy"
+        if not self.enabled:
+            return fn()
+        import random
+
+        delay = self.BACKOFF_START
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            try:
+                return fn()
+            except sqlite3.OperationalError as ex:
+                if not _is_busy(ex):
+                    raise
+                if attempt == self.MAX_ATTEMPTS:
+                    raise click.ClickException(
+                        "Database was still locked after {} attempts - try a "
+                        "longer --busy-timeout".format(attempt)
+                    )
+            stats.counts["busy"] += 1
+            with stats.timer("busy"):
+                # Jitter stops retries from lining up with the other writer's
+                time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, self.BACKOFF_MAX)
+
+    def pause(self, rows, busy_seconds, stats):
+        "Sleep after a batch of rows that took busy_seconds, if needed"
+        if not self.enabled:
+            return
+        self.rows += rows
+        delay = 0.0
+        if self.duty_cycle:
+            delay = busy_seconds * (1 - self.duty_cycle) / self.duty_cycle
+        if self.rate:
+            delay = max(delay, self.start + self.rows / self.rate - time.perf_counter())
+        if delay > 0:
+            with stats.timer("throttle"):
+                time.sleep(delay)
+
+
+def _is_busy(ex):
+    # sqlite_errorcode is only available from Python 3.11
+    code = getattr(ex, "sqlite_errorcode", None)
+    if code is not None:
+        # The low byte is the primary code, e.g. SQLITE_BUSY for SQLITE_BUSY_SNAPSHOT
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(ex)
+
+
+# How often per-value progress counters are flushed, in rows or in SQLite
+# virtual machine instructions for set_progress_handler()
+PROGRESS_EVERY = 1000
+PROGRESS_HANDLER_INSTRUCTIONS = 100000
+
+
+def _db_paths(db_path, dbs=()):
+    import glob
+
+    # DB_PATH can be a glob pattern, quoted so the shell doesn't expand it
+    if glob.has_magic(db_path):
+        paths = sorted(glob.glob(db_path))
+        if not paths:
+            raise click.ClickException("No database files match {}".format(db_path))
+    else:
+        paths = [db_path]
+    return paths + [path for path in dbs if path not in paths]
+
+
+def _run(transform, db_path, table, args, kwargs):
+    """
+    Call transform(db_path, table, *args, **kwargs) for every database file
+    and table selected by DB_PATH, --db and --table
+
+    A single database and table is transformed in this process as usual.
+    Otherwise each one gets its own connection, optionally in a pool of
+    --jobs processes, with one progress bar and a summary across them all.
+    Each process works on one database file at a time, transforming its
+    tables in turn, as SQLite only allows one writer per file.
+    """
+    kwargs = dict(kwargs)
+    jobs = kwargs.pop("jobs")
+    tables = [table] + [name for name in kwargs.pop("tables") if name != table]
+    targets = [
+        (path, name)
+        for path in _db_paths(db_path, kwargs.pop("dbs"))
+        for name in tables
+    ]
+    if len(targets) == 1:
+        transform(*targets[0], *args, **kwargs)
+        return
+    if kwargs["profile"] or kwargs["stats_json"]:
+        raise click.ClickException(
+            "--profile and --stats-json can only be used with a single table"
+        )
+    if kwargs["dry_run"] or kwargs["sample"]:
+        raise click.ClickException(
+            "--dry-run and --sample can only be used with a single table"
+        )
+    if jobs > 1 and kwargs.get("workers"):
+        raise click.ClickException("Cannot use --workers with --jobs")
+    if kwargs.get("output_db") and (jobs > 1 or len({path for path, _ in targets}) > 1):
+        raise click.ClickException(
+            "--output-db can only be used with a single database and no --jobs"
+        )
+    silent, progress_json = kwargs["silent"], kwargs["progress_json"]
+    kwargs.update(silent=True, progress_json=False)
+    run_target = functools.partial(_run_target, transform, args, kwargs)
+    start = time.perf_counter()
+    results = []
+    with Progress(len(targets), silent, progress_json, desc="Tables") as bar:
+        if jobs > 1:
+            import multiprocessing
+
+            by_path = {}
+            for target in targets:
+                by_path.setdefault(target[0], []).append(target)
+            with multiprocessing.Pool(min(jobs, len(by_path))) as pool:
+                for path_results in pool.imap_unordered(
+                    functools.partial(_run_targets, run_target), by_path.values()
+                ):
+                    results.extend(path_results)
+                    bar.update(len(path_results))
+        else:
+            for target in targets:
+                results.append(run_target(target))
+                bar.update(1)
+    failed = [result for result in results if result["error"]]
+    if not silent:
+        results.sort(
+            key=lambda result: (targets.index((result["db"], result["table"])))
+        )
+        for result in results:
+            click.echo(
+                "{db} {table}: {outcome}".format(
+                    outcome=(
+                        "failed - {}".format(result["error"])
+                        if result["error"]
+                        else "{:,} values in {:.2f}s".format(
+                            result["values"], result["seconds"]
+                        )
+                    ),
+                    **result
+                ),
+                err=True,
+            )
+        click.echo(
+            "Transformed {:,} values in {:,} tables in {:.2f}s".format(
+                sum(result["values"] or 0 for result in results),
+                len(results) - len(failed),
+                time.perf_counter() - start,
+            ),
+            err=True,
+        )
+    if failed:
+        raise click.ClickException(
+            "{} of {} tables failed".format(len(failed), len(targets))
+        )
+
+
+def _run_targets(run_target, targets):
+    # Module level so it can be sent to a multiprocessing pool
+    return [run_target(target) for target in targets]
+
+
+def _run_target(transform, args, kwargs, target):
+    # Module level so it can be sent to a multiprocessing pool
+    db_path, table = target
+    start = time.perf_counter()
+    values, error = None, None
+    try:
+        values = transform(db_path, table, *args, **kwargs)
+    except click.ClickException as ex:
+        error = ex.format_message()
+    except Exception as ex:
+        error = "{}: {}".format(type(ex).__name__, ex)
+    return {
+        "db": db_path,
+        "table": table,
+        "values": values,
+        "seconds": time.perf_counter() - start,
+        "error": error,
+    }
+
+
+# Used by --fast: a write-ahead log and fewer fsyncs, with a large page
+# cache and memory-mapped reads. temp_store is left alone, as the --multi
+# and --dedupe temporary tables are there to keep large runs out of memory.
+FAST_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": "-262144",
+    "mmap_size": str(1024 * 1024 * 1024),
+}
+
+
+@contextlib.contextmanager
+def _pragmas(db, fast=False, pragmas=()):
+    # Applied for the length of the run, then set back to how they were
+    settings = dict(FAST_PRAGMAS) if fast else {}
+    for pragma in pragmas:
+        name, _, value = (part.strip() for part in pragma.partition("="))
+        if not (name.replace("_", "").isalpha() and value.replace("-", "").isalnum()):
+            raise click.ClickException(
+                "--pragma should look like name=value, e.g. synchronous=off"
+            )
+        settings[name.lower()] = value
+    original = {}
+    for name, value in settings.items():
+        row = db.execute("pragma {}".format(name)).fetchone()
+        if row is not None:
+            original[name] = row[0]
+        db.execute("pragma {} = {}".format(name, value))
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            db.execute("pragma {} = {}".format(name, value))
+
+
+@contextlib.contextmanager
+def _run_stats(profile, stats_json):
+    # Reports even if the run fails, since that is often when it's needed
+    stats = RunStats(enabled=bool(profile or stats_json))
+    try:
+        yield stats
+    finally:
+        if stats.enabled:
+            report = stats.report()
+            if profile:
+                click.echo(stats.format(report), err=True)
+            if stats_json:
+                with click.open_file(stats_json, "w") as fp:
+                    json.dump(report, fp, indent=2)
+
+
+def _transform(
+    db_path,
+    table,
+    columns,
+    fn,
+    output=None,
+    output_type=None,
+    drop=False,
+    silent=False,
+    batch_size=None,
+    batch_time=None,
+    workers=None,
+    dedupe=None,
+    profile=False,
+    stats_json=None,
+    progress_json=False,
+    where=None,
+    params=(),
+    vectorized=False,
+    sql_pushdown=None,
+    fast=False,
+    pragmas=(),
+    vacuum=False,
+    dry_run=False,
+    sample=None,
+    estimate_count=False,
+    on_error=None,
+    errors_table=None,
+    output_db=None,
+    online=False,
+    busy_timeout=None,
+    rate=None,
+    duty_cycle=None,
+):
+    import sqlite_utils
+
+    if output_db and isinstance(db_path, str):
+        db = _open_read_only(db_path)
+    else:
+        db = sqlite_utils.Database(db_path)
+    params = dict(params)
+    fns, outputs = _per_column(columns, fn, output)
 
     if drop and not output:
         raise click.ClickException("--drop can only be used with --output or --multi")
+    _check_vacuum(db, vacuum, drop)
+    if batch_time and not (batch_size or workers or vectorized):
+        raise click.ClickException(
+            "--batch-time can only be used with --batch-size, --workers or --batch"
+        )
+    if dedupe and (batch_size or workers or vectorized):
+        raise click.ClickException(
+            "--dedupe cannot be used with --batch-size, --workers or --batch"
+        )
+    if sql_pushdown and (dedupe or batch_size or workers):
+        raise click.ClickException(
+            "--sql-pushdown cannot be used with --dedupe, --batch-size or --workers"
+        )
+    if errors_table and not on_error:
+        on_error = "skip"
+    if rate == 0:
+        raise click.ClickException("--rate must be greater than 0")
+    if (busy_timeout is not None or rate is not None or duty_cycle) and not online:
+        raise click.ClickException(
+            "--busy-timeout, --rate and --duty-cycle can only be used with --online"
+        )
+    if online and (dedupe or sql_pushdown or output_db):
+        raise click.ClickException(
+            "--online cannot be used with --dedupe, --sql-pushdown or --output-db"
+        )
+    if on_error and sql_pushdown:
+        raise click.ClickException(
+            "--sql-pushdown cannot be used with --on-error or --errors-table"
+        )
+    todo_count = None
+    if sample or not dry_run:
+        # A --dry-run preview only reads the first rows, so skips the count
+        todo_count = _count_rows(db, table, where, params, estimate_count)
+        todo_count *= len(columns)
+    if dry_run or sample:
+        _dry_run(
+            db,
+            table,
+            columns,
+            fns,
+            todo_count,
+            replaces=drop or outputs == list(columns),
+            vectorized=vectorized,
+            sample=sample,
+            stats_json=stats_json,
+            where=where,
+            params=params,
+        )
+        return todo_count
+    if output_db:
+        if drop or dedupe or sql_pushdown:
+            raise click.ClickException(
+                "--output-db cannot be used with --drop, --dedupe or --sql-pushdown"
+            )
+        out = sqlite_utils.Database(output_db)
+        with _pragmas(out, fast, pragmas), _run_stats(
+            profile, stats_json
+        ) as stats, Progress(todo_count, silent, progress_json) as bar:
+            _transform_to_db(
+                db,
+                out,
+                table,
+                columns,
+                fns,
+                outputs,
+                output_type,
+                bar,
+                stats,
+                batch_size or DEFAULT_BATCH_SIZE,
+                workers,
+                where,
+                params,
+                vectorized,
+                on_error,
+                errors_table,
+            )
+            bar.set_total(bar.n)
+        _echo_failures(stats, silent, errors_table)
+        return bar.n
+    if dedupe is None:
+        dedupe = not (
+            batch_size or workers or sql_pushdown or online
+        ) and _is_low_cardinality(db, table, columns, where, params)
 
-    if output is not None:
-        if output not in db[table].columns_dict:
-            db[table].add_column(output, output_type or "text")
+    for output_column in dict.fromkeys(outputs):
+        if output_column not in db[table].columns_dict:
+            db[table].add_column(output_column, output_type or "text")
+    dropped = [column for column in columns if column not in outputs]
+
+    if online:
+        # Applied before any --pragma, so --pragma busy_timeout=N still works
+        pragmas = (
+            "busy_timeout={}".format(
+                int(
+                    (ONLINE_BUSY_TIMEOUT if busy_timeout is None else busy_timeout)
+                    * 1000
+                )
+            ),
+        ) + tuple(pragmas)
+    with _pragmas(db, fast, pragmas), _run_stats(
+        profile, stats_json
+    ) as stats, Progress(todo_count, silent, progress_json) as bar:
+        if batch_size or workers or vectorized or online:
+            # Workers and vectorized code are fed rowid-ranged batches, and
+            # --online commits in short transactions, so they imply batch mode
+            _transform_batched(
+                db,
+                table,
+                columns,
+                fn,
+                output,
+                batch_size or (ONLINE_BATCH_SIZE if online else DEFAULT_BATCH_SIZE),
+                batch_time,
+                bar,
+                stats,
+                workers,
+                where,
+                params,
+                vectorized,
+                estimate_count,
+                on_error,
+                errors_table,
+                Throttle(online, rate, duty_cycle),
+                silent,
+            )
+            if drop:
+                with db.conn, stats.timer("drop"):
+                    _drop_columns(db, table, dropped)
+        elif dedupe:
+            with db.conn:
+                _transform_dedupe(
+                    db,
+                    table,
+                    columns,
+                    fn,
+                    output,
+                    bar,
+                    stats,
+                    where,
+                    params,
+                    on_error,
+                    errors_table,
+                )
+                if drop:
+                    with stats.timer("drop"):
+                        _drop_columns(db, table, dropped)
+                with stats.timer("commit"):
+                    db.conn.commit()
+        else:
+            timed_fns = [stats.wrap(fn) for fn in fns]
+            if on_error:
+                timed_fns = [_catch_errors(fn) for fn in timed_fns]
+            failures = []
+            # Counted here and flushed to the progress bar from a SQLite
+            # progress handler, keeping the bar off the per-value path
+            counted = [0, 0]
+            rows_seen = [0]
 
-    with tqdm.tqdm(total=todo_count, disable=silent) as bar:
+            def transform_value(i, v):
+                counted[0] += 1
+                if not v:
+                    return v
+                return timed_fns[i](v)
 
-        def transform_value(v):
-            bar.update(1)
-            if not v:
-                return v
-            return fn(v)
+            def flush_progress():
+                bar.update(counted[0] - counted[1])
+                counted[1] = counted[0]
 
-        db.register_function(transform_value)
-        sql = "update [{table}] set {sets};".format(
-            table=table,
-            sets=", ".join(
-                [
-                    "[{output_column}] = transform_value([{column}])".format(
-                        output_column=output or column, column=column
+            # The key and results of the last row that changes, from the WHERE
+            # clause to the SET clause. SQLite usually evaluates both for a row
+            # before moving on to the next, but can find every matching row
+            # before updating any of them, so a result is worked out again if
+            # it isn't the last row's rather than holding them all in memory.
+            last = [None, None]
+
+            def transform_row(key, *values):
+                # Called with each column's value and its output's current value
+                rows_seen[0] += 1
+                results = [
+                    transform_value(i, value) for i, value in enumerate(values[::2])
+                ]
+                if on_error:
+                    results = _resolve_failures(
+                        key,
+                        columns,
+                        values[::2],
+                        values[1::2],
+                        results,
+                        on_error,
+                        failures,
+                    )
+                if not _changed(values[1::2], results):
+                    return False
+                last[:] = [key, results]
+                return True
+
+            def transform_result(key, i, value, current):
+                if key == last[0]:
+                    return last[1][i]
+                result = timed_fns[i](value) if value else value
+                if on_error:
+                    # The failure was recorded by transform_row()
+                    result = _resolve_failures(
+                        key, [columns[i]], [value], [current], [result], on_error, []
+                    )[0]
+                return result
+
+            db.register_function(transform_value)
+            db.register_function(transform_result)
+            db.conn.create_function("transform_row", -1, transform_row)
+            db.conn.set_progress_handler(flush_progress, PROGRESS_HANDLER_INSTRUCTIONS)
+            if sql_pushdown:
+                # Skipping unchanged rows would mean evaluating the SQL twice
+                sets = [
+                    _pushdown(
+                        sql_pushdown,
+                        "[{}]".format(column),
+                        "transform_value({}, [{}])".format(i, column),
+                    )
+                    for i, column in enumerate(columns)
+                ]
+                guard = _where_clause(where)
+            else:
+                key = _row_key_sql(db, table)
+                sets = [
+                    "transform_result({}, {}, [{}], [{}])".format(
+                        key, i, column, output_column
                     )
-                    for column in columns
+                    for i, (column, output_column) in enumerate(zip(columns, outputs))
                 ]
+                guard = "transform_row({}, {})".format(
+                    key,
+                    ", ".join(
+                        "[{}], [{}]".format(column, output_column)
+                        for column, output_column in zip(columns, outputs)
+                    ),
+                )
+                if where:
+                    # The case guarantees fn is only called for rows matching
+                    # --where, and repeating the clause outside of it lets
+                    # SQLite use an index to find those rows
+                    guard = "({where}) and case when ({where}) then {guard} end".format(
+                        where=where, guard=guard
+                    )
+                guard = " where " + guard
+            sql = "update [{table}] set {sets}{guard};".format(
+                table=table,
+                sets=", ".join(
+                    "[{}] = {}".format(output_column, value)
+                    for output_column, value in zip(outputs, sets)
+                ),
+                guard=guard,
+            )
+            with db.conn:
+                with stats.timer("sql"):
+                    try:
+                        written = db.execute(sql, params).rowcount
+                    finally:
+                        db.conn.set_progress_handler(None, 0)
+                        flush_progress()
+                # Every row is written when using SQL, and values transformed
+                # by SQL never reached transform_value()
+                rows = written if sql_pushdown else rows_seen[0]
+                stats.counts["sql"] += rows * len(columns) - counted[0]
+                bar.update(rows * len(columns) - counted[0])
+                stats.counts["scanned"] += rows * len(columns)
+                stats.counts["writes_skipped"] += rows - written
+                _record_errors(db, errors_table, table, failures)
+                stats.counts["failed"] += len(failures)
+                if drop:
+                    with stats.timer("drop"):
+                        _drop_columns(db, table, dropped)
+                with stats.timer("commit"):
+                    db.conn.commit()
+        # Correct the total, in case it was estimated
+        bar.set_total(bar.n)
+        if vacuum:
+            with stats.timer("vacuum"):
+                _vacuum(db)
+    _echo_failures(stats, silent, errors_table)
+    return bar.n
+
+
+def _count_rows(db, table, where=None, params=None, estimate=False):
+    if not estimate:
+        return db.execute(
+            "select count(*) from [{}]{}".format(table, _where_clause(where)),
+            params or {},
+        ).fetchone()[0]
+    # Estimates ignore any where clause, so are an upper bound. ANALYZE keeps
+    # a row count in sqlite_stat1, which is the best estimate if present.
+    if db["sqlite_stat1"].exists():
+        count = db.execute(
+            "select max(cast(stat as integer)) from sqlite_stat1 where tbl = ?",
+            [table],
+        ).fetchone()[0]
+        if count is not None:
+            return count
+    if "without rowid" not in db[table].schema.lower():
+        low, high = db.execute(
+            "select min(rowid), max(rowid) from [{}]".format(table)
+        ).fetchone()
+        return 0 if low is None else high - low + 1
+    # Otherwise guess from the size of the database file and of a few rows
+    rows = db.execute("select * from [{}] limit 100".format(table)).fetchall()
+    if not rows:
+        return 0
+    row_size = sum(_value_size(value) for row in rows for value in row) / len(rows)
+    page_count = db.execute("pragma page_count").fetchone()[0]
+    page_size = db.execute("pragma page_size").fetchone()[0]
+    return int(page_count * page_size / max(row_size, 1))
+
+
+def _changed(values, results):
+    # 1 and 1.0 are equal in Python, but would be stored differently
+    return any(
+        result != value or type(result) is not type(value)
+        for value, result in zip(values, results)
+    )
+
+
+def _row_key_sql(db, table):
+    # Identifies a row within a single UPDATE statement
+    if "without rowid" not in db[table].schema.lower():
+        return "rowid"
+    pks = db[table].pks
+    if len(pks) == 1:
+        return "[{}]".format(pks[0])
+    return "json_array({})".format(", ".join("[{}]".format(pk) for pk in pks))
+
+
+class TransformFailed:
+    """
+    Returned in place of a result by functions wrapped with _catch_errors(),
+    holding the exception as a string so it can be sent back from --workers
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _catch_errors(fn, vectorized=False):
+    if isinstance(fn, AsyncBatch):
+        # Catches errors from each call, so the rest of the batch still runs
+        return AsyncBatch(fn.fn, fn.concurrency, catch_errors=True)
+    # A partial rather than a closure, so it can be pickled for --workers
+    return functools.partial(_call_catching_batch if vectorized else _call_catching, fn)
+
+
+def _failed(ex):
+    return TransformFailed("{}: {}".format(type(ex).__name__, ex))
+
+
+def _call_catching(fn, value):
+    try:
+        return fn(value)
+    except Exception as ex:
+        return _failed(ex)
+
+
+def _call_catching_batch(fn, values):
+    try:
+        return fn(values)
+    except Exception:
+        # Retry one value at a time to find out which of them failed
+        return [
+            _call_catching(lambda value: _transform_values(fn, [value], True)[0], value)
+            for value in values
+        ]
+
+
+def _resolve_failures(key, columns, values, currents, results, on_error, failures):
+    # Replaces each TransformFailed result with what --on-error says to write,
+    # given the output column's current value, and appends a
+    # (key, column, value, error) tuple to failures
+    resolved = []
+    for column, value, current, result in zip(columns, values, currents, results):
+        if isinstance(result, TransformFailed):
+            failures.append((key, column, value, result.error))
+            result = {"skip": current, "null": None, "keep": value}[on_error]
+        resolved.append(result)
+    return resolved
+
+
+def _record_errors(db, errors_table, table, failures):
+    if not errors_table or not failures:
+        return
+    _create_errors_table(db, errors_table)
+    db.conn.executemany(
+        "insert into [{}] ([table], [key], [column], value, error) "
+        "values (?, ?, ?, ?, ?)".format(errors_table),
+        [(table,) + tuple(failure) for failure in failures],
+    )
+
+
+def _create_errors_table(db, errors_table):
+    # key has no declared type so it keeps the type of the rowid or primary key
+    db.execute(
+        "create table if not exists [{}] "
+        "([table] text, [key], [column] text, value, error text)".format(errors_table)
+    )
+
+
+def _echo_failures(stats, silent, errors_table):
+    failed = stats.counts["failed"]
+    if failed and not silent:
+        click.echo(
+            "{:,} value{} could not be transformed{}".format(
+                failed,
+                "" if failed == 1 else "s",
+                ", see the {} table".format(errors_table) if errors_table else "",
+            ),
+            err=True,
+        )
+
+
+def _pushdown(sql_pushdown, column, fallback):
+    expression = sql_pushdown(column) if sql_pushdown else None
+    if expression is None:
+        return fallback
+    # coalesce() only evaluates the fallback if the expression returns null
+    return "coalesce({}, {})".format(expression, fallback)
+
+
+DRY_RUN_PREVIEW = 10
+DRY_RUN_ERROR_EXAMPLES = 3
+
+
+def _dry_run(
+    db,
+    table,
+    columns,
+    fns,
+    todo_count,
+    replaces=True,
+    vectorized=False,
+    sample=None,
+    stats_json=None,
+    where=None,
+    params=None,
+    row=False,
+):
+    # With row=True there is a single fn, called with a dictionary of columns.
+    # todo_count is only used to scale up a sample.
+    if not sample:
+        # Preview the first rows of the first column, or of the row
+        values = [
+            dict(zip(columns, values)) if row else values[0]
+            for values in db.execute(
+                "select {columns} from [{table}]{where} limit {limit}".format(
+                    columns=", ".join(
+                        "[{}]".format(column)
+                        for column in (columns if row else columns[:1])
+                    ),
+                    table=table,
+                    where=_where_clause(where),
+                    limit=DRY_RUN_PREVIEW,
+                ),
+                params or {},
+            )
+        ]
+        results = _transform_values(fns[0], values, vectorized)
+        for value, result in zip(values, results):
+            click.echo(str(value))
+            click.echo(" --- becomes:")
+            click.echo(str(result))
+            click.echo()
+        return
+    rows = _sample_rows(db, table, columns, sample, where, params)
+    counts = collections.Counter()
+    seconds = 0.0
+    size_change = 0
+    errors = []
+    if row:
+        value_lists = [[dict(zip(columns, values[1:])) for values in rows]]
+    else:
+        value_lists = [[values[i + 1] for values in rows] for i in range(len(fns))]
+    for fn, values in zip(fns, value_lists):
+        start = time.perf_counter()
+        if vectorized:
+            try:
+                results = _transform_values(fn, values, vectorized)
+            except Exception as ex:
+                errors.append((repr(values[:1])[:100], ex))
+                results = [ex if value else value for value in values]
+        else:
+            results = []
+            for value in values:
+                try:
+                    results.append(fn(value) if value else value)
+                except Exception as ex:
+                    errors.append((repr(value)[:100], ex))
+                    results.append(ex)
+        seconds += time.perf_counter() - start
+        for value, result in zip(values, results):
+            if not value:
+                counts["empty"] += 1
+            elif isinstance(result, Exception):
+                counts["errors"] += 1
+            elif result == value:
+                counts["unchanged"] += 1
+            else:
+                counts["changed"] += 1
+                size_change += _value_size(result) - (
+                    _value_size(value) if replaces else 0
+                )
+    sampled = len(rows) * len(fns)
+    scale = todo_count / sampled if sampled else 0
+    report = {
+        "rows_sampled": len(rows),
+        "values_sampled": sampled,
+        "values_total": todo_count,
+        "changed": counts["changed"],
+        "unchanged": counts["unchanged"],
+        "empty": counts["empty"],
+        "errors": counts["errors"],
+        "seconds_per_value": seconds / sampled if sampled else None,
+        "estimated_seconds": seconds * scale,
+        "estimated_size_change": int(size_change * scale),
+        "error_examples": [
+            "{}: {}: {}".format(value, type(ex).__name__, ex)
+            for value, ex in errors[:DRY_RUN_ERROR_EXAMPLES]
+        ],
+    }
+    lines = [
+        "Sampled {:,} of {:,} values".format(sampled, todo_count),
+    ]
+    for key in ("changed", "unchanged", "empty", "errors"):
+        lines.append(
+            "  {}: {:,} ({:.1%})".format(
+                key.capitalize(), report[key], report[key] / sampled if sampled else 0
+            )
+        )
+    lines.append(
+        "Estimated time in the transform function: {:.1f}s".format(
+            report["estimated_seconds"]
+        )
+    )
+    lines.append(
+        "Estimated change in size: {:+,} bytes".format(report["estimated_size_change"])
+    )
+    if report["error_examples"]:
+        lines.append("Example errors:")
+        lines.extend("  " + example for example in report["error_examples"])
+    click.echo("\n".join(lines))
+    if stats_json:
+        with click.open_file(stats_json, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+
+def _sample_rows(db, table, columns, size, where=None, params=None):
+    # Picks a random row from each of size equal slices of the rowid range,
+    # so the sample is spread across old and new rows and each row is found
+    # with an index lookup rather than the full sort of order by random()
+    import random
+
+    params = dict(params or {})
+    if "without rowid" in db[table].schema.lower():
+        return db.execute(
+            "select null, {columns} from [{table}]{where} "
+            "order by random() limit {size}".format(
+                columns=", ".join("[{}]".format(column) for column in columns),
+                table=table,
+                where=_where_clause(where),
+                size=size,
+            ),
+            params,
+        ).fetchall()
+    select = "select rowid, {columns} from [{table}]".format(
+        columns=", ".join("[{}]".format(column) for column in columns),
+        table=table,
+    )
+    low, high = db.execute(
+        "select min(rowid), max(rowid) from [{}]".format(table)
+    ).fetchone()
+    if low is None:
+        return []
+    step = (high - low + 1) / size
+    if step <= 1:
+        return db.execute(
+            "{}{} limit {}".format(select, _where_clause(where), size), params
+        ).fetchall()
+    rows = {}
+    for i in range(size):
+        start = low + int(i * step) + random.randrange(max(1, int(step)))
+        row = db.execute(
+            "{} where rowid >= :_start{} order by rowid limit 1".format(
+                select, _where_clause(where, " and ")
+            ),
+            dict(params, _start=start),
+        ).fetchone()
+        if row is not None:
+            rows[row[0]] = row
+    return list(rows.values())
+
+
+def _value_size(value):
+    from sqlite_utils.db import jsonify_if_needed
+
+    # Roughly how many bytes SQLite uses to store the value
+    if isinstance(value, dict):
+        return sum(_value_size(item) for item in value.values())
+    value = jsonify_if_needed(value)
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, bytes):
+        return len(value)
+    return 8
+
+
+DEDUPE_SAMPLE_SIZE = 10000
+DEDUPE_MAX_DISTINCT_RATIO = 0.5
+
+
+def _is_low_cardinality(db, table, columns, where=None, params=None):
+    # Estimate cardinality from the first rows rather than scanning the table
+    for column in columns:
+        distinct, total = db.execute(
+            "select count(distinct [{column}]), count(*) from "
+            "(select [{column}] from [{table}]{where} limit {limit})".format(
+                column=column,
+                table=table,
+                where=_where_clause(where),
+                limit=DEDUPE_SAMPLE_SIZE,
             ),
+            params or {},
+        ).fetchone()
+        if not total or distinct / total > DEDUPE_MAX_DISTINCT_RATIO:
+            return False
+    return True
+
+
+def _transform_dedupe(
+    db,
+    table,
+    columns,
+    fn,
+    output,
+    bar,
+    stats,
+    where=None,
+    params=None,
+    on_error=None,
+    errors_table=None,
+):
+    # Transform each distinct value once into a temporary mapping table,
+    # then apply that mapping to every row with a single UPDATE
+    for column, fn, output_column in zip(columns, *_per_column(columns, fn, output)):
+        fn = stats.wrap(fn)
+        if on_error:
+            fn = _catch_errors(fn)
+        # (value, error, rows) for each distinct value that failed
+        failed = []
+        db.execute("drop table if exists temp.[_sqlite_transform_dedupe]")
+        db.execute(
+            "create temp table [_sqlite_transform_dedupe] (value primary key, result)"
+        )
+
+        scanned = [0]
+
+        def mappings():
+            for value, count in db.conn.execute(
+                "select [{column}], count(*) from [{table}]{where} "
+                "group by [{column}]".format(
+                    column=column, table=table, where=_where_clause(where)
+                ),
+                params or {},
+            ):
+                bar.update(count)
+                stats.counts["scanned"] += count
+                scanned[0] += count
+                if value is None:
+                    continue
+                result = fn(value) if value else value
+                if isinstance(result, TransformFailed):
+                    failed.append((value, result.error, count))
+                    if on_error == "skip":
+                        # Rows with no mapping are left alone
+                        continue
+                    result = None if on_error == "null" else value
+                yield value, result
+
+        with stats.timer("sql"):
+            db.conn.executemany(
+                "insert into temp.[_sqlite_transform_dedupe] (value, result) "
+                "values (?, ?)",
+                mappings(),
+            )
+        # Rows that already hold the result are not written
+        unchanged = (
+            "dedupe.result is [{table}].[{output}] "
+            "and typeof(dedupe.result) = typeof([{table}].[{output}])"
+        )
+        if sqlite3.sqlite_version_info >= (3, 33, 0):
+            sql = (
+                "update [{table}] set [{output}] = dedupe.result "
+                "from temp.[_sqlite_transform_dedupe] as dedupe "
+                "where dedupe.value = [{table}].[{column}] "
+                "and not (" + unchanged + "){where}"
+            )
+        else:
+            sql = (
+                "update [{table}] set [{output}] = ("
+                "select result from temp.[_sqlite_transform_dedupe] "
+                "where value = [{table}].[{column}]) "
+                "where not exists (select 1 from temp.[_sqlite_transform_dedupe] "
+                "as dedupe where dedupe.value = [{table}].[{column}] "
+                "and " + unchanged + ") and [{column}] in "
+                "(select value from temp.[_sqlite_transform_dedupe]){where}"
+            )
+        with stats.timer("sql"):
+            written = db.execute(
+                sql.format(
+                    table=table,
+                    output=output_column,
+                    column=column,
+                    where=_where_clause(where, " and "),
+                ),
+                params or {},
+            ).rowcount
+            if output_column != column:
+                written += db.execute(
+                    "update [{table}] set [{output}] = null "
+                    "where [{column}] is null and [{output}] is not null{where}".format(
+                        table=table,
+                        output=output_column,
+                        column=column,
+                        where=_where_clause(where, " and "),
+                    ),
+                    params or {},
+                ).rowcount
+        stats.counts["writes_skipped"] += scanned[0] - written
+        stats.counts["failed"] += sum(rows for _, _, rows in failed)
+        if errors_table and failed:
+            _create_errors_table(db, errors_table)
+            for value, error, _ in failed:
+                db.execute(
+                    "insert into [{errors_table}] "
+                    "([table], [key], [column], value, error) "
+                    "select :_table, {key}, :_column, [{column}], :_error "
+                    "from [{table}] where [{column}] = :_value{where}".format(
+                        errors_table=errors_table,
+                        key=_row_key_sql(db, table),
+                        column=column,
+                        table=table,
+                        where=_where_clause(where, " and "),
+                    ),
+                    dict(
+                        params or {},
+                        _table=table,
+                        _column=column,
+                        _error=error,
+                        _value=value,
+                    ),
+                )
+        db.execute("drop table temp.[_sqlite_transform_dedupe]")
+
+
+def _per_column(columns, fn, output):
+    # fn and output are either shared by every column or lists with an entry
+    # for each column, as used by Pipeline
+    fns = list(fn) if isinstance(fn, (list, tuple)) else [fn] * len(columns)
+    if isinstance(output, (list, tuple)):
+        outputs = list(output)
+    else:
+        outputs = [output or column for column in columns]
+    return fns, outputs
+
+
+PROGRESS_TABLE = "_sqlite_transform_progress"
+DEFAULT_BATCH_SIZE = 10000
+
+# Set in each --workers process by _init_worker, one fn per column
+_worker_fn = None
+
+
+def _init_worker(fns):
+    global _worker_fn
+    _worker_fn = fns
+
+
+def _transform_rows(rows, fns=None, vectorized=False):
+    # Takes (key, *values) rows and a fn for each value, returns
+    # [*new_values, key] lists for UPDATE
+    fns = fns or _worker_fn
+    results = [
+        _transform_values(fn, [row[i + 1] for row in rows], vectorized)
+        for i, fn in enumerate(fns)
+    ]
+    return [[result[j] for result in results] + [row[0]] for j, row in enumerate(rows)]
+
+
+def _transform_values(fn, values, vectorized=False):
+    # Empty and null values are passed through without calling fn
+    if not vectorized:
+        return [fn(value) if value else value for value in values]
+    todo = [value for value in values if value]
+    results = fn(todo) if todo else []
+    if hasattr(results, "tolist"):
+        # For example a NumPy array
+        results = results.tolist()
+    results = list(results)
+    if len(results) != len(todo):
+        raise click.ClickException(
+            "With --batch code must return a list with one result per value - "
+            "returned {} results for {} values".format(len(results), len(todo))
         )
+    results = iter(results)
+    return [next(results) if value else value for value in values]
+
+
+def _transform_batched(
+    db,
+    table,
+    columns,
+    fn,
+    output,
+    batch_size,
+    batch_time,
+    bar,
+    stats,
+    workers=None,
+    where=None,
+    params=None,
+    vectorized=False,
+    estimate=False,
+    on_error=None,
+    errors_table=None,
+    throttle=None,
+    silent=False,
+):
+    # Walk the table in key order, committing a checkpoint with each batch
+    # so that an interrupted run can pick up where it left off
+    throttle = throttle or Throttle()
+    key = _key_column(db, table)
+    job = [table, list(columns), output, _describe_transform(fn)]
+    if where:
+        job += [where, params]
+    job = json.dumps(job)
+    # last_key has no declared type so it keeps the type of the key column
+    throttle.retry(
+        lambda: db.execute(
+            "create table if not exists [{}] "
+            "(job text primary key, last_key, rows_done integer)".format(PROGRESS_TABLE)
+        ),
+        stats,
+    )
+    last_key, rows_done = None, 0
+    checkpoint = list(
+        db.execute(
+            "select last_key, rows_done from [{}] where job = ?".format(PROGRESS_TABLE),
+            [job],
+        ).fetchall()
+    )
+    if checkpoint:
+        last_key, rows_done = checkpoint[0]
+        bar.update(rows_done * len(columns))
+        if not silent:
+            click.echo(
+                "Resuming after {:,} rows done by an earlier run".format(rows_done),
+                err=True,
+            )
+    fns, outputs = _per_column(columns, fn, output)
+    update_sql = "update [{table}] set {sets} where [{key}] = ?".format(
+        table=table,
+        sets=", ".join("[{}] = ?".format(output_column) for output_column in outputs),
+        key=key,
+    )
+    if throttle.enabled:
+        # Rows changed by another connection since they were read are left
+        # for that connection's value to stand
+        update_sql += "".join(" and [{}] is ?".format(column) for column in columns)
+    # Output columns are read too, so rows that wouldn't change are skipped
+    read = list(columns) + [
+        output_column
+        for output_column in dict.fromkeys(outputs)
+        if output_column not in columns
+    ]
+    bounds = None
+    if estimate and key == "rowid":
+        # Re-estimate the total from how far through the rowids each batch is
+        bounds = db.execute(
+            "select min(rowid), max(rowid) from [{}]".format(table)
+        ).fetchone()
+    done = [rows_done]
+
+    def write(rows, currents, updates, failures):
+        done[0] += len(rows)
+        updates = [
+            # --online also checks the values read are still there
+            update + (list(row[1 : len(columns) + 1]) if throttle.enabled else [])
+            for row, current, update in zip(rows, currents, updates)
+            if _changed(current, update[:-1])
+        ]
+        stats.counts["writes_skipped"] += len(rows) - len(updates)
+        if bounds and bounds[1] > bounds[0]:
+            fraction = (rows[-1][0] - bounds[0] + 1) / (bounds[1] - bounds[0] + 1)
+            bar.set_total(max(bar.n, int(done[0] / fraction) * len(columns)))
+
+        def commit():
+            with db.conn:
+                with stats.timer("sql"):
+                    written = db.conn.executemany(update_sql, updates).rowcount
+                    _record_errors(db, errors_table, table, failures)
+                    db.execute(
+                        "replace into [{}] (job, last_key, rows_done) "
+                        "values (?, ?, ?)".format(PROGRESS_TABLE),
+                        [job, rows[-1][0], done[0]],
+                    )
+                with stats.timer("commit"):
+                    db.conn.commit()
+            return written
+
+        written = throttle.retry(commit, stats)
+        stats.counts["writes_skipped"] += len(updates) - max(written, 0)
+
+    _transform_in_batches(
+        db,
+        table,
+        key,
+        columns,
+        outputs,
+        read,
+        fns,
+        write,
+        bar,
+        stats,
+        batch_size,
+        batch_time,
+        last_key,
+        workers,
+        where,
+        params,
+        vectorized,
+        on_error,
+        throttle,
+    )
+
+    def finish():
         with db.conn:
-            db.execute(sql)
-            if drop:
-                db[table].transform(drop=columns)
+            db.execute("delete from [{}] where job = ?".format(PROGRESS_TABLE), [job])
+            if not db[PROGRESS_TABLE].count:
+                db[PROGRESS_TABLE].drop()
+
+    throttle.retry(finish, stats)
+
+
+def _transform_in_batches(
+    db,
+    table,
+    key,
+    columns,
+    outputs,
+    read,
+    fns,
+    write,
+    bar,
+    stats,
+    batch_size,
+    batch_time=None,
+    last_key=None,
+    workers=None,
+    where=None,
+    params=None,
+    vectorized=False,
+    on_error=None,
+    throttle=None,
+):
+    """
+    Reads (key, *read) rows in key order after last_key, a batch at a time,
+    and transforms each column with its fn in this process or in a pool of
+    workers. read starts with columns, followed by any output columns to
+    compare the results against.
+
+    Calls write(rows, currents, updates, failures) for each batch, where
+    currents are the output columns' values, updates are [*results, key]
+    lists and failures are the (key, column, value, error) tuples that
+    --on-error resolved.
+    """
+    throttle = throttle or Throttle()
+    position = {name: i + 1 for i, name in enumerate(read)}
+    # Calls can only be timed individually if they are made one value at a time
+    # in this process, otherwise whole batches are recorded
+    per_call = not (workers or vectorized)
+    timed_fns = [stats.wrap(fn) for fn in fns] if per_call else fns
+    if on_error:
+        timed_fns = [_catch_errors(fn, vectorized) for fn in timed_fns]
+    pool = None
+    if workers:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(
+            workers, initializer=_init_worker, initargs=(timed_fns,)
+        )
+    try:
+        while True:
+            start = time.perf_counter()
+            with stats.timer("sql"):
+                rows = throttle.retry(
+                    lambda: _next_batch(
+                        db, table, key, read, last_key, batch_size, where, params
+                    ),
+                    stats,
+                )
+            if not rows:
+                break
+            updates = _evaluate_batch(
+                [row[: len(columns) + 1] for row in rows],
+                timed_fns,
+                stats,
+                pool,
+                workers,
+                vectorized,
+            )
+            bar.update(len(rows) * len(columns))
+            stats.counts["scanned"] += len(rows) * len(columns)
+            last_key = rows[-1][0]
+            # An output column that doesn't exist yet is null
+            currents = [
+                [row[position[name]] if name in position else None for name in outputs]
+                for row in rows
+            ]
+            failures = []
+            if on_error:
+                updates = [
+                    _resolve_failures(
+                        row[0],
+                        columns,
+                        row[1 : len(columns) + 1],
+                        current,
+                        update[:-1],
+                        on_error,
+                        failures,
+                    )
+                    + [update[-1]]
+                    for row, current, update in zip(rows, currents, updates)
+                ]
+                if not per_call:
+                    stats.counts["errors"] += len(failures)
+            write(rows, currents, updates, failures)
+            stats.counts["failed"] += len(failures)
+            elapsed = max(time.perf_counter() - start, 0.000001)
+            if batch_time:
+                # Scale towards the target, at most doubling or halving each time
+                batch_size = max(
+                    1,
+                    int(batch_size * min(2.0, max(0.5, batch_time / elapsed))),
+                )
+            throttle.pause(len(rows), elapsed, stats)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _describe_transform(fn):
+    # Identifies the command and options or code in a checkpoint's job, so a
+    # run only resumes from a checkpoint left by the same transform. The
+    # strptime() formats are left out, as inferred formats change once some
+    # rows have been converted and would stop a parsedate run resuming.
+    if isinstance(fn, (list, tuple)):
+        return [_describe_transform(item) for item in fn]
+    if isinstance(fn, AsyncBatch):
+        return _describe_transform(fn.fn)
+    if isinstance(fn, CompiledCode):
+        return ["lambda", fn.__getstate__()]
+    if isinstance(fn, functools.partial):
+        return [
+            _describe_transform(fn.func),
+            {
+                name: value
+                for name, value in sorted(fn.keywords.items())
+                if name != "formats"
+            },
+        ]
+    return getattr(fn, "__name__", type(fn).__name__)
+
+
+OUTPUT_DB_MMAP_SIZE = 256 * 1024 * 1024
+# Records the transform that wrote each results table in an --output-db
+OUTPUT_JOBS_TABLE = "_sqlite_transform_output"
+
+
+def _open_read_only(db_path):
+    # mode=ro means this connection never takes a write lock on the source,
+    # and memory-mapped reads save copying pages through SQLite's cache
+    import pathlib
+    import sqlite_utils
+
+    if not pathlib.Path(db_path).exists():
+        raise click.ClickException("Database {} does not exist".format(db_path))
+    conn = sqlite3.connect(
+        pathlib.Path(db_path).resolve().as_uri() + "?mode=ro", uri=True
+    )
+    conn.execute("pragma mmap_size = {}".format(OUTPUT_DB_MMAP_SIZE))
+    return sqlite_utils.Database(conn)
+
+
+def _transform_to_db(
+    db,
+    out,
+    table,
+    columns,
+    fns,
+    outputs,
+    output_type,
+    bar,
+    stats,
+    batch_size,
+    workers=None,
+    where=None,
+    params=None,
+    vectorized=False,
+    on_error=None,
+    errors_table=None,
+):
+    # Results are written to a table with the same name in the out database,
+    # keyed by the source's rowid or primary key, so nothing is written to
+    # the source. Each batch is committed, and a run of the same transform
+    # picks up after the last key already in that table.
+    from sqlite_utils.db import jsonify_if_needed
+
+    key = _key_column(db, table)
+    output_columns = list(dict.fromkeys(outputs))
+    # Where several columns share an output the last one wins, as in an UPDATE
+    result_index = {name: i for i, name in enumerate(outputs)}
+    job = [list(columns), outputs, _describe_transform(fns)]
+    if where:
+        job += [where, params]
+    job = json.dumps(job)
+    with out.conn:
+        out.execute(
+            "create table if not exists [{}] "
+            "([table] text primary key, job text)".format(OUTPUT_JOBS_TABLE)
+        )
+        if out[table].exists():
+            if list(out[table].columns_dict) != [key] + output_columns:
+                raise click.ClickException(
+                    "Table {} in --output-db has columns {}, not {}".format(
+                        table,
+                        ", ".join(out[table].columns_dict),
+                        ", ".join([key] + output_columns),
+                    )
+                )
+            written_by = out.execute(
+                "select job from [{}] where [table] = ?".format(OUTPUT_JOBS_TABLE),
+                [table],
+            ).fetchone()
+            if written_by is None or written_by[0] != job:
+                raise click.ClickException(
+                    "Table {} in --output-db holds results from a different "
+                    "transform - delete it to start again".format(table)
+                )
+        else:
+            out.execute(
+                "create table [{table}] ([{key}]{key_type} primary key, "
+                "{columns})".format(
+                    table=table,
+                    key=key,
+                    key_type=" integer" if key == "rowid" else "",
+                    columns=", ".join(
+                        "[{}] {}".format(output_column, output_type or "text")
+                        for output_column in output_columns
+                    ),
+                )
+            )
+            out.execute(
+                "replace into [{}] ([table], job) values (?, ?)".format(
+                    OUTPUT_JOBS_TABLE
+                ),
+                [table, job],
+            )
+    last_key, rows_done = out.execute(
+        "select max([{key}]), count(*) from [{table}]".format(key=key, table=table)
+    ).fetchone()
+    bar.update(rows_done * len(columns))
+    insert_sql = "replace into [{table}] ([{key}], {columns}) values ({values})".format(
+        table=table,
+        key=key,
+        columns=", ".join("[{}]".format(name) for name in output_columns),
+        values=", ".join("?" for _ in range(len(output_columns) + 1)),
+    )
+    # Existing output columns in the source are what --on-error skip keeps
+    existing = db[table].columns_dict
+    read = list(columns) + [
+        name for name in output_columns if name not in columns and name in existing
+    ]
+
+    def write(rows, currents, updates, failures):
+        with out.conn:
+            with stats.timer("sql"):
+                out.conn.executemany(
+                    insert_sql,
+                    [
+                        [update[-1]]
+                        + [
+                            jsonify_if_needed(update[result_index[name]])
+                            for name in output_columns
+                        ]
+                        for update in updates
+                    ],
+                )
+                _record_errors(out, errors_table, table, failures)
+            with stats.timer("commit"):
+                out.conn.commit()
+
+    _transform_in_batches(
+        db,
+        table,
+        key,
+        columns,
+        outputs,
+        read,
+        fns,
+        write,
+        bar,
+        stats,
+        batch_size,
+        last_key=last_key,
+        workers=workers,
+        where=where,
+        params=params,
+        vectorized=vectorized,
+        on_error=on_error,
+    )
+
+
+def _evaluate_batch(values, fns, stats, pool=None, workers=None, vectorized=False):
+    # Transforms (key, *values) rows in this process or spread across the
+    # pool, recording the batch if calls couldn't be timed individually
+    start = time.perf_counter()
+    if pool is not None:
+        size = max(1, -(-len(values) // (workers * 4)))
+        updates = [
+            update
+            for chunk in pool.map(
+                functools.partial(_transform_rows, vectorized=vectorized),
+                [values[i : i + size] for i in range(0, len(values), size)],
+            )
+            for update in chunk
+        ]
+    else:
+        updates = _transform_rows(values, fns, vectorized)
+    if stats.enabled and (pool is not None or vectorized):
+        stats.record_batch(
+            [value for row in values for value in row[1:]],
+            [value for update in updates for value in update[:-1]],
+            time.perf_counter() - start,
+        )
+    return updates
+
+
+def _next_batch(db, table, key, columns, after, size, where=None, params=None):
+    # Returns up to size (key, *columns) rows with a key greater than after
+    wheres = []
+    if after is not None:
+        wheres.append("[{}] > :_after".format(key))
+    if where:
+        wheres.append("({})".format(where))
+    sql = (
+        "select [{key}], {columns} from [{table}]{where} "
+        "order by [{key}] limit :_size".format(
+            key=key,
+            columns=", ".join("[{}]".format(column) for column in columns),
+            table=table,
+            where=" where " + " and ".join(wheres) if wheres else "",
+        )
+    )
+    params = dict(params or {}, _after=after, _size=size)
+    return db.execute(sql, params).fetchall()
+
+
+def _drop_columns(db, table, columns):
+    # ALTER TABLE DROP COLUMN avoids copying the whole table into a new one,
+    # but SQLite refuses it for columns that are indexed, unique, part of the
+    # primary key or used by a constraint, trigger or view
+    rebuild = []
+    for column in columns:
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            try:
+                db.execute("alter table [{}] drop column [{}]".format(table, column))
+                continue
+            except sqlite3.OperationalError:
+                pass
+        rebuild.append(column)
+    if rebuild:
+        db[table].transform(drop=rebuild)
+
+
+def _check_vacuum(db, vacuum, drop):
+    # Checked before the run, rather than finding out once it's done
+    if not vacuum:
+        return
+    if not drop:
+        raise click.ClickException("--vacuum can only be used with --drop")
+    # A full VACUUM would rebuild the whole database file, needing as much
+    # free disk space again, so only an incremental vacuum is run
+    if db.execute("pragma auto_vacuum").fetchone()[0] != 2:
+        raise click.ClickException(
+            "--vacuum needs a database with auto_vacuum=incremental - run "
+            "PRAGMA auto_vacuum=incremental followed by VACUUM to switch it over"
+        )
+
+
+def _vacuum(db):
+    # Only frees pages, so is much cheaper than VACUUM rebuilding the database
+    db.execute("pragma incremental_vacuum").fetchall()
+
+
+def _where_clause(where, prefix=" where "):
+    return "{}({})".format(prefix, where) if where else ""
+
+
+def _key_column(db, table):
+    # Tables without a rowid must be walked by their single primary key
+    if "without rowid" not in db[table].schema.lower():
+        return "rowid"
+    pks = db[table].pks
+    if len(pks) != 1:
+        raise click.ClickException(
+            "WITHOUT ROWID tables need a single column primary key for batching"
+        )
+    return pks[0]
+
+
+MULTI_TABLE = "_sqlite_transform_multi"
+MULTI_SPILL_BATCH_SIZE = 1000
+
 
+def _single_output(output, fn, value):
+    return {output: fn(value)}
+
+
+def _transform_multi(
+    db_path,
+    table,
+    columns,
+    fn,
+    drop,
+    silent,
+    batch_size=None,
+    profile=False,
+    stats_json=None,
+    progress_json=False,
+    where=None,
+    params=None,
+    fast=False,
+    pragmas=(),
+    vacuum=False,
+    dry_run=False,
+    sample=None,
+    estimate_count=False,
+    on_error=None,
+    errors_table=None,
+    row=False,
+    output_types=None,
+):
+    # fn returns a dictionary of columns to set, and is called with the value
+    # of the single column, or with a dictionary of every column if row=True.
+    # New columns get a type to suit the values returned, unless they are in
+    # output_types.
+    import sqlite_utils
 
-def _transform_multi(db_path, table, column, fn, drop, silent):
     db = sqlite_utils.Database(db_path)
-    # First we execute the function
-    pk_to_values = {}
+    _check_vacuum(db, vacuum, drop)
+    if dry_run or sample:
+        todo_count = None
+        if sample:
+            # Only a --sample is scaled up to the whole table
+            todo_count = _count_rows(db, table, where, params, estimate_count)
+        _dry_run(
+            db,
+            table,
+            list(columns),
+            [fn],
+            todo_count,
+            replaces=drop,
+            sample=sample,
+            stats_json=stats_json,
+            where=where,
+            params=params,
+            row=row,
+        )
+        return todo_count
+    with _pragmas(db, fast, pragmas), _run_stats(profile, stats_json) as stats:
+        todo_count = _transform_multi_phases(
+            db,
+            table,
+            columns,
+            fn,
+            drop,
+            silent,
+            batch_size,
+            stats,
+            progress_json,
+            where,
+            params,
+            estimate_count,
+            errors_table,
+            on_error=bool(on_error or errors_table),
+            pass_row=row,
+            output_types=output_types,
+        )
+        if vacuum:
+            with stats.timer("vacuum"):
+                _vacuum(db)
+    _echo_failures(stats, silent, errors_table)
+    return todo_count
+
+
+def _transform_multi_phases(
+    db,
+    table,
+    columns,
+    fn,
+    drop,
+    silent,
+    batch_size,
+    stats,
+    progress_json,
+    where,
+    params,
+    estimate_count=False,
+    errors_table=None,
+    on_error=False,
+    pass_row=False,
+    output_types=None,
+):
+    import pickle
+    from sqlite_utils.db import jsonify_if_needed
+
+    fn = stats.wrap(fn)
+    if on_error:
+        # A row whose code raised an exception has no keys to write, so it is
+        # always skipped
+        fn = _catch_errors(fn)
+    failures = []
+    # First we execute the function, spilling the results to a temporary
+    # table in batches so they are never all held in memory at once
+    db.execute("drop table if exists temp.[{}]".format(MULTI_TABLE))
+    db.execute("create temp table [{}] (pk blob, [values] blob)".format(MULTI_TABLE))
+    insert_sql = "insert into temp.[{}] (pk, [values]) values (?, ?)".format(
+        MULTI_TABLE
+    )
+    spill = []
     new_column_types = {}
     pks = [column.name for column in db[table].columns if column.is_pk]
     if not pks:
         pks = ["rowid"]
-    with tqdm.tqdm(total=db[table].count, disable=silent, desc="1: Evaluating") as bar:
+    counted = 0
+    spilled = 0
+    todo_count = _count_rows(db, table, where, params, estimate_count)
+    with Progress(todo_count, silent, progress_json, desc="1: Evaluating") as bar:
         for row in db[table].rows_where(
+            where,
+            params,
             select=", ".join(
-                "[{}]".format(column_name) for column_name in (pks + [column])
-            )
+                "[{}]".format(column_name)
+                for column_name in dict.fromkeys(pks + list(columns))
+            ),
         ):
             row_pk = tuple(row[pk] for pk in pks)
             if len(row_pk) == 1:
                 row_pk = row_pk[0]
-            values = fn(row[column])
+            if pass_row:
+                value = {column: row[column] for column in columns}
+            else:
+                value = row[columns[0]]
+            values = fn(value)
+            if isinstance(values, TransformFailed):
+                failures.append(
+                    (
+                        json.dumps(list(row_pk), separators=(",", ":"))
+                        if isinstance(row_pk, tuple)
+                        else row_pk,
+                        ", ".join(columns),
+                        json.dumps(value, default=repr) if pass_row else value,
+                        values.error,
+                    )
+                )
+                values = None
             if values is not None and not isinstance(values, dict):
                 raise click.ClickException(
                     "With --multi code must return a Python dictionary - returned {}".format(
@@ -288,23 +2860,88 @@ def _transform_multi(db_path, table, column, fn, drop, silent):
             if values:
                 for key, value in values.items():
                     new_column_types.setdefault(key, set()).add(type(value))
-                pk_to_values[row_pk] = values
-            bar.update(1)
+                spill.append((pickle.dumps(row_pk), pickle.dumps(values)))
+                spilled += 1
+                if len(spill) >= MULTI_SPILL_BATCH_SIZE:
+                    with stats.timer("sql"):
+                        db.conn.executemany(insert_sql, spill)
+                    spill = []
+            counted += 1
+            if counted == PROGRESS_EVERY:
+                bar.update(counted)
+                stats.counts["scanned"] += counted
+                counted = 0
+        bar.update(counted)
+        stats.counts["scanned"] += counted
+        todo_count = bar.n
+        bar.set_total(todo_count)
+        if spill:
+            with stats.timer("sql"):
+                db.conn.executemany(insert_sql, spill)
 
     # Add any new columns
     columns_to_create = _suggest_column_types(new_column_types)
+    columns_to_create.update(output_types or {})
     for column_name, column_type in columns_to_create.items():
         if column_name not in db[table].columns_dict:
             db[table].add_column(column_name, column_type)
 
-    # Run the updates
-    with tqdm.tqdm(total=db[table].count, disable=silent, desc="2: Updating") as bar:
+    # Run the updates, grouping rows by the keys they set so that each group
+    # can be written with a single executemany() call
+    def write(groups):
+        for keys, params in groups.items():
+            with stats.timer("sql"):
+                db.conn.executemany(
+                    "update [{table}] set {sets} where {wheres}".format(
+                        table=table,
+                        sets=", ".join("[{}] = ?".format(key) for key in keys),
+                        wheres=" and ".join("[{}] = ?".format(pk) for pk in pks),
+                    ),
+                    params,
+                )
+            bar.update(len(params))
+
+    flush_size = batch_size or MULTI_SPILL_BATCH_SIZE
+    with Progress(spilled, silent, progress_json, desc="2: Updating") as bar:
         with db.conn:
-            for pk, updates in pk_to_values.items():
-                db[table].update(pk, updates)
-                bar.update(1)
+            groups = {}
+            buffered = 0
+            for pk, updates in db.conn.execute(
+                "select pk, [values] from temp.[{}]".format(MULTI_TABLE)
+            ):
+                pk, updates = pickle.loads(pk), pickle.loads(updates)
+                keys = tuple(updates)
+                groups.setdefault(keys, []).append(
+                    [jsonify_if_needed(updates[key]) for key in keys]
+                    + list(pk if isinstance(pk, tuple) else (pk,))
+                )
+                buffered += 1
+                if buffered >= flush_size:
+                    write(groups)
+                    groups = {}
+                    buffered = 0
+                    if batch_size:
+                        with stats.timer("commit"):
+                            db.conn.commit()
+            write(groups)
+            _record_errors(db, errors_table, table, failures)
+            stats.counts["failed"] += len(failures)
             if drop:
-                db[table].transform(drop=(column,))
+                with stats.timer("drop"):
+                    # Unless the code wrote back to them
+                    _drop_columns(
+                        db,
+                        table,
+                        [
+                            column
+                            for column in columns
+                            if column not in new_column_types
+                        ],
+                    )
+            db.execute("drop table temp.[{}]".format(MULTI_TABLE))
+            with stats.timer("commit"):
+                db.conn.commit()
+    return todo_count
 
 
 def _suggest_column_types(all_column_types):
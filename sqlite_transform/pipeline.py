@@ -0,0 +1,158 @@
+import click
+import functools
+from .cli import (
+    CompiledCode,
+    _infer_date_formats,
+    _jsonsplit,
+    _parse_date,
+    _parse_datetime,
+    _transform,
+)
+
+TRANSFORMS = ("parsedate", "parsedatetime", "jsonsplit", "lambda")
+
+
+class Pipeline:
+    """
+    Several column transforms applied to a table in a single pass:
+
+        Pipeline().parsedate("created").jsonsplit("tags").lambda_(
+            "title", "value.strip()"
+        ).run("my.db", "articles")
+
+    Every column is read by the same table scan and written by the same
+    UPDATE, so the table is only rewritten once.
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    def parsedate(
+        self, column, output=None, dayfirst=False, yearfirst=False, formats=None
+    ):
+        return self._add(
+            "parsedate",
+            column,
+            output,
+            dayfirst=dayfirst,
+            yearfirst=yearfirst,
+            formats=formats,
+        )
+
+    def parsedatetime(
+        self, column, output=None, dayfirst=False, yearfirst=False, formats=None
+    ):
+        return self._add(
+            "parsedatetime",
+            column,
+            output,
+            dayfirst=dayfirst,
+            yearfirst=yearfirst,
+            formats=formats,
+        )
+
+    def jsonsplit(self, column, output=None, delimiter=",", type=None):
+        return self._add("jsonsplit", column, output, delimiter=delimiter, type=type)
+
+    def lambda_(self, column, code, output=None, imports=()):
+        return self._add("lambda", column, output, code=code, imports=tuple(imports))
+
+    def _add(self, transform, column, output, **options):
+        outputs = [step["output"] or step["column"] for step in self.steps]
+        if (output or column) in outputs:
+            raise click.ClickException(
+                "More than one step writes to column {}".format(output or column)
+            )
+        self.steps.append(
+            dict(transform=transform, column=column, output=output, **options)
+        )
+        return self
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Build a pipeline from a list of steps, or a dictionary with a "steps"
+        key, where each step looks like {"parsedate": "created", ...}
+        """
+        if isinstance(spec, dict):
+            spec = spec.get("steps") or []
+        pipeline = cls()
+        for step in spec:
+            step = dict(step)
+            transforms = [key for key in TRANSFORMS if key in step]
+            if len(transforms) != 1:
+                raise click.ClickException(
+                    "Each step needs exactly one of {}".format(", ".join(TRANSFORMS))
+                )
+            column = step.pop(transforms[0])
+            if "import" in step:
+                step["imports"] = step.pop("import")
+            if isinstance(step.get("formats"), str):
+                step["formats"] = [step["formats"]]
+            method = getattr(
+                pipeline, "lambda_" if transforms[0] == "lambda" else transforms[0]
+            )
+            try:
+                method(column, **step)
+            except TypeError as ex:
+                raise click.ClickException(
+                    "Invalid {} step: {}".format(transforms[0], ex)
+                )
+        return pipeline
+
+    def run(self, db, table, where=None, params=None, silent=True, **kwargs):
+        """
+        Transform every step's column in table, returning the number of values
+        processed. db can be a path or a sqlite_utils Database, and kwargs
+        accepts the same options as the command-line tools.
+        """
+        import sqlite_utils
+
+        if not self.steps:
+            raise click.ClickException("Pipeline has no steps")
+        if isinstance(db, sqlite_utils.Database):
+            db = db.conn
+        params = dict(params or {})
+        if kwargs.get("dedupe") is None and (
+            len(self.steps) > 1 or self.steps[0]["transform"] == "lambda"
+        ):
+            # Deduping writes each column with its own UPDATE, so is only
+            # used for several steps if requested. As with the lambda
+            # command, code is only deduped if requested too.
+            kwargs["dedupe"] = False
+        columns = [step["column"] for step in self.steps]
+        return _transform(
+            db,
+            table,
+            columns,
+            [self._fn(step, db, table, where, params) for step in self.steps],
+            output=[step["output"] or step["column"] for step in self.steps],
+            silent=silent,
+            where=where,
+            params=params,
+            **kwargs
+        )
+
+    def _fn(self, step, db, table, where, params):
+        transform = step["transform"]
+        if transform == "lambda":
+            return CompiledCode(step["code"], step["imports"])
+        if transform == "jsonsplit":
+            return functools.partial(
+                _jsonsplit, delimiter=step["delimiter"], type=step["type"]
+            )
+        return functools.partial(
+            _parse_date if transform == "parsedate" else _parse_datetime,
+            dayfirst=step["dayfirst"],
+            yearfirst=step["yearfirst"],
+            formats=tuple(step["formats"] or ())
+            or _infer_date_formats(
+                db,
+                table,
+                [step["column"]],
+                step["dayfirst"],
+                step["yearfirst"],
+                where,
+                params,
+            ),
+        )
@@ -0,0 +1,162 @@
+from click.testing import CliRunner
+from sqlite_transform import cli
+import json
+import pytest
+
+
+@pytest.mark.parametrize("batch_size", (1, 2, 3, 10))
+def test_batch_size(test_db_and_path, batch_size):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["parsedatetime", db_path, "example", "dt", "--batch-size", str(batch_size)],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [
+        {"id": 1, "dt": "2019-10-05T12:04:00"},
+        {"id": 2, "dt": "2019-10-06T00:05:06"},
+        {"id": 3, "dt": ""},
+        {"id": 4, "dt": None},
+    ] == list(db["example"].rows)
+    # Progress table should have been cleaned up
+    assert not db[cli.PROGRESS_TABLE].exists()
+
+
+def test_batch_size_output_drop(test_db_and_path):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "parsedate",
+            db_path,
+            "example",
+            "dt",
+            "--batch-size",
+            "3",
+            "--batch-time",
+            "0.5",
+            "--output",
+            "parsed",
+            "--drop",
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [
+        {"id": 1, "parsed": "2019-10-05"},
+        {"id": 2, "parsed": "2019-10-06"},
+        {"id": 3, "parsed": ""},
+        {"id": 4, "parsed": None},
+    ] == list(db["example"].rows)
+
+
+# Fails on the fourth row if FAIL is set, after committing two batches of two
+RESUME_ARGS = ["--batch-size", "2", "--import", "os", "--code"]
+RESUME_ARGS += [
+    "assert not (value == 'name4' and os.environ.get('FAIL'))\nreturn value + '!'"
+]
+
+
+@pytest.fixture
+def interrupted_db_and_path(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["example"].insert_all(
+        [{"id": i, "name": "name{}".format(i)} for i in range(1, 6)], pk="id"
+    )
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "example", "name"] + RESUME_ARGS,
+        env={"FAIL": "1"},
+    )
+    assert result.exit_code == 1
+    assert isinstance(result.exception, AssertionError)
+    assert [r["name"] for r in db["example"].rows] == [
+        "name1!",
+        "name2!",
+        "name3",
+        "name4",
+        "name5",
+    ]
+    return db, db_path
+
+
+def test_batch_resume(interrupted_db_and_path):
+    db, db_path = interrupted_db_and_path
+    checkpoint = list(db[cli.PROGRESS_TABLE].rows)[0]
+    assert json.loads(checkpoint["job"]) == [
+        "example",
+        ["name"],
+        None,
+        [
+            "lambda",
+            {
+                "argument": "value",
+                "code": RESUME_ARGS[-1],
+                "imports": ["os"],
+                "is_async": False,
+            },
+        ],
+    ]
+    assert (checkpoint["last_key"], checkpoint["rows_done"]) == (2, 2)
+    # Running the same command again picks up from the last committed batch
+    result = CliRunner().invoke(
+        cli.cli, ["lambda", db_path, "example", "name"] + RESUME_ARGS
+    )
+    assert 0 == result.exit_code, result.output
+    assert "Resuming after 2 rows done by an earlier run" in result.output
+    assert [r["name"] for r in db["example"].rows] == [
+        "name1!",
+        "name2!",
+        "name3!",
+        "name4!",
+        "name5!",
+    ]
+    assert not db[cli.PROGRESS_TABLE].exists()
+
+
+@pytest.mark.parametrize(
+    "command,expected",
+    (
+        (["lambda", "--code", "value + '?'"], "name1!?"),
+        (["jsonsplit"], '["name1!"]'),
+        (["jsonsplit", "--delimiter", "e"], '["nam", "1!"]'),
+    ),
+)
+def test_batch_resume_different_transform(interrupted_db_and_path, command, expected):
+    db, db_path = interrupted_db_and_path
+    # A different command or code starts again rather than resuming
+    result = CliRunner().invoke(
+        cli.cli,
+        command[:1] + [db_path, "example", "name", "--batch-size", "2"] + command[1:],
+    )
+    assert 0 == result.exit_code, result.output
+    assert "Resuming" not in result.output
+    assert [r["name"] for r in db["example"].rows][0] == expected
+    # The other run's checkpoint is left for it to resume from
+    assert db[cli.PROGRESS_TABLE].count == 1
+
+
+def test_batch_without_rowid(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db.execute("create table example (code text primary key, tags text) without rowid")
+    db["example"].insert_all([{"code": "b", "tags": "1,2"}, {"code": "a", "tags": "3"}])
+    result = CliRunner().invoke(
+        cli.cli,
+        ["jsonsplit", db_path, "example", "tags", "--batch-size", "1", "--type", "int"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert list(db.execute("select code, tags from example order by code")) == [
+        ("a", "[3]"),
+        ("b", "[1, 2]"),
+    ]
+
+
+def test_batch_time_requires_batch_size(test_db_and_path):
+    _, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "example", "dt", "--batch-time", "1"]
+    )
+    assert result.exit_code == 1
+    assert (
+        "--batch-time can only be used with --batch-size, --workers or --batch"
+        in result.output
+    )
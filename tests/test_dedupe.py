@@ -0,0 +1,115 @@
+from click.testing import CliRunner
+from sqlite_transform import cli
+import pytest
+
+
+@pytest.fixture
+def low_cardinality_db_and_path(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    dates = ["5th October 2019", "6th October 2019", "", None]
+    db["example"].insert_all(
+        [{"id": i, "dt": dates[i % len(dates)]} for i in range(100)], pk="id"
+    )
+    return db, db_path
+
+
+@pytest.fixture
+def parse_date_calls(monkeypatch):
+    calls = []
+    parse_date = cli._parse_date
+
+    def counting_parse_date(value, **kwargs):
+        calls.append(value)
+        return parse_date(value, **kwargs)
+
+    monkeypatch.setattr(cli, "_parse_date", counting_parse_date)
+    return calls
+
+
+@pytest.mark.parametrize("old_sqlite", (False, True))
+@pytest.mark.parametrize("options", ([], ["--dedupe"]))
+def test_dedupe(
+    low_cardinality_db_and_path, parse_date_calls, monkeypatch, old_sqlite, options
+):
+    db, db_path = low_cardinality_db_and_path
+    if old_sqlite:
+        # Exercise the correlated subquery used before UPDATE ... FROM
+        monkeypatch.setattr(cli.sqlite3, "sqlite_version_info", (3, 32, 0))
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "example", "dt"] + options
+    )
+    assert 0 == result.exit_code, result.output
+    assert sorted(parse_date_calls) == ["5th October 2019", "6th October 2019"]
+    rows = list(db["example"].rows)
+    assert len(rows) == 100
+    assert rows[:5] == [
+        {"id": 0, "dt": "2019-10-05"},
+        {"id": 1, "dt": "2019-10-06"},
+        {"id": 2, "dt": ""},
+        {"id": 3, "dt": None},
+        {"id": 4, "dt": "2019-10-05"},
+    ]
+
+
+def test_no_dedupe(low_cardinality_db_and_path, parse_date_calls):
+    db, db_path = low_cardinality_db_and_path
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "example", "dt", "--no-dedupe"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert len(parse_date_calls) == 50
+
+
+def test_dedupe_not_used_for_high_cardinality(test_db_and_path, parse_date_calls):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(cli.cli, ["parsedate", db_path, "example", "dt"])
+    assert 0 == result.exit_code, result.output
+    # Called from the per-row UPDATE, which does not sort its input
+    assert parse_date_calls == ["5th October 2019 12:04", "6th October 2019 00:05:06"]
+
+
+@pytest.mark.parametrize("drop", (True, False))
+def test_dedupe_lambda_output(low_cardinality_db_and_path, drop):
+    db, db_path = low_cardinality_db_and_path
+    db["example"].add_column("upper")
+    # Pre-populate output column to check null values are written too
+    with db.conn:
+        db.execute("update example set upper = 'x'")
+    args = [
+        "lambda",
+        db_path,
+        "example",
+        "dt",
+        "--code",
+        "value.upper()",
+        "--output",
+        "upper",
+        "--dedupe",
+    ]
+    if drop:
+        args += ["--drop"]
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    expected = [
+        {"id": 0, "dt": "5th October 2019", "upper": "5TH OCTOBER 2019"},
+        {"id": 1, "dt": "6th October 2019", "upper": "6TH OCTOBER 2019"},
+        {"id": 2, "dt": "", "upper": ""},
+        {"id": 3, "dt": None, "upper": None},
+    ]
+    if drop:
+        for row in expected:
+            del row["dt"]
+    assert list(db["example"].rows)[:4] == expected
+
+
+def test_dedupe_cannot_be_used_with_batch_size(test_db_and_path):
+    _, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["parsedate", db_path, "example", "dt", "--dedupe", "--batch-size", "10"],
+    )
+    assert result.exit_code == 1
+    assert (
+        "--dedupe cannot be used with --batch-size, --workers or --batch"
+        in result.output
+    )
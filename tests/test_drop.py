@@ -0,0 +1,97 @@
+from click.testing import CliRunner
+from sqlite_transform import cli, Pipeline
+import pytest
+import sqlite3
+import sqlite_utils
+
+needs_drop_column = pytest.mark.skipif(
+    sqlite3.sqlite_version_info < (3, 35, 0),
+    reason="ALTER TABLE DROP COLUMN needs SQLite 3.35",
+)
+
+
+def _statements(db, fn):
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    try:
+        fn()
+    finally:
+        db.conn.set_trace_callback(None)
+    return statements
+
+
+@needs_drop_column
+def test_drop_uses_alter_table(test_db_and_path):
+    db, db_path = test_db_and_path
+    statements = _statements(
+        db,
+        lambda: Pipeline()
+        .parsedate("dt", output="parsed")
+        .run(db, "example", drop=True),
+    )
+    assert "alter table [example] drop column [dt]" in statements
+    assert not any(sql.startswith("CREATE TABLE") for sql in statements)
+    assert db["example"].columns_dict == {"id": int, "parsed": str}
+
+
+def test_drop_constrained_column_rebuilds(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db.execute(
+        "create table example (id integer primary key, dt text, check (dt != 'x'))"
+    )
+    db["example"].insert({"id": 1, "dt": "5th October 2019"})
+    statements = _statements(
+        db,
+        lambda: Pipeline()
+        .parsedate("dt", output="parsed")
+        .run(db, "example", drop=True),
+    )
+    assert any(sql.startswith("CREATE TABLE") for sql in statements)
+    assert db["example"].columns_dict == {"id": int, "parsed": str}
+    assert db["example"].get(1)["parsed"] == "2019-10-05"
+
+
+@pytest.mark.parametrize("multi", (False, True))
+def test_vacuum(fresh_db_and_path, multi):
+    db, db_path = fresh_db_and_path
+    db.execute("pragma auto_vacuum = incremental")
+    db["t"].insert_all([{"id": i, "body": "x" * 1000} for i in range(1000)], pk="id")
+    args = ["lambda", db_path, "t", "body", "--drop", "--vacuum"]
+    if multi:
+        args += ["--multi", "--code", "{'size': len(value)}"]
+    else:
+        args += ["--output", "size", "--output-type", "integer"]
+        args += ["--code", "len(value)"]
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert db["t"].get(5) == {"id": 5, "size": 1000}
+    assert db.execute("pragma freelist_count").fetchone()[0] == 0
+
+
+def test_vacuum_needs_drop(test_db_and_path):
+    _, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "example", "dt", "--vacuum"]
+    )
+    assert result.exit_code == 1
+    assert "--vacuum can only be used with --drop" in result.output
+
+
+@pytest.mark.parametrize("multi", (False, True))
+def test_vacuum_needs_incremental_auto_vacuum(fresh_db_and_path, multi):
+    db, db_path = fresh_db_and_path
+    db["t"].insert_all([{"id": i, "body": "x" * 1000} for i in range(100)], pk="id")
+    args = ["lambda", db_path, "t", "body", "--drop", "--vacuum"]
+    if multi:
+        args += ["--multi", "--code", "{'size': len(value)}"]
+    else:
+        args += ["--output", "size", "--code", "len(value)"]
+    result = CliRunner().invoke(cli.cli, args)
+    assert result.exit_code == 1
+    assert (
+        "--vacuum needs a database with auto_vacuum=incremental - run "
+        "PRAGMA auto_vacuum=incremental followed by VACUUM to switch it over"
+    ) in result.output
+    # Nothing was changed
+    assert db["t"].columns_dict == {"id": int, "body": str}
@@ -0,0 +1,132 @@
+from click.testing import CliRunner
+from sqlite_transform import cli
+import json
+import pathlib
+import pytest
+
+ORIGINAL = [
+    {"id": 1, "dt": "5th October 2019 12:04"},
+    {"id": 2, "dt": "6th October 2019 00:05:06"},
+    {"id": 3, "dt": ""},
+    {"id": 4, "dt": None},
+]
+
+
+def test_parsedate_dry_run(test_db_and_path):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["parsedate", db_path, "example", "dt", "--dry-run", "--output", "parsed"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert result.output.startswith(
+        "5th October 2019 12:04\n --- becomes:\n2019-10-05\n\n"
+    )
+    assert list(db["example"].rows) == ORIGINAL
+
+
+def test_sample(test_db_and_path, tmpdir):
+    db, db_path = test_db_and_path
+    db["example"].insert({"id": 5, "dt": "unchanged"})
+    stats_path = str(pathlib.Path(tmpdir) / "stats.json")
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "example",
+            "dt",
+            "--code",
+            "assert value != '6th October 2019 00:05:06', 'nope'\n"
+            "return value if value == 'unchanged' else 'changed!'",
+            "--sample",
+            "100",
+            "--stats-json",
+            stats_path,
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    assert result.output.splitlines()[:5] == [
+        "Sampled 5 of 5 values",
+        "  Changed: 1 (20.0%)",
+        "  Unchanged: 1 (20.0%)",
+        "  Empty: 2 (40.0%)",
+        "  Errors: 1 (20.0%)",
+    ]
+    assert "Estimated change in size: -14 bytes" in result.output
+    assert "'6th October 2019 00:05:06': AssertionError: nope" in result.output
+    report = json.load(open(stats_path))
+    assert report["values_total"] == 5
+    assert report["estimated_size_change"] == -14
+    assert list(db["example"].rows) == ORIGINAL + [{"id": 5, "dt": "unchanged"}]
+
+
+def test_sample_multi(test_db_and_path):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "example", "dt", "--multi", "--sample", "10"]
+        + ["--code", "{'year': 2019, 'month': 'October'}"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert result.output.splitlines()[:2] == [
+        "Sampled 4 of 4 values",
+        "  Changed: 2 (50.0%)",
+    ]
+    assert "Estimated change in size: +30 bytes" in result.output
+    assert "year" not in db["example"].columns_dict
+
+
+@pytest.mark.parametrize("without_rowid", (False, True))
+def test_sample_rows_spread(fresh_db_and_path, without_rowid):
+    db, db_path = fresh_db_and_path
+    db.execute(
+        "create table t (id integer primary key, v integer){}".format(
+            " without rowid" if without_rowid else ""
+        )
+    )
+    db["t"].insert_all([{"id": i, "v": i} for i in range(1000)])
+    rows = cli._sample_rows(db, "t", ["v"], 10)
+    assert len(rows) == 10
+    if not without_rowid:
+        # One from each tenth of the table
+        assert sorted(row[1] // 100 for row in rows) == list(range(10))
+    rows = cli._sample_rows(db, "t", ["v"], 10, "v % 2 = :two", {"two": 0})
+    assert rows
+    assert all(row[1] % 2 == 0 for row in rows)
+
+
+def test_dry_run_single_table(test_db_and_path):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["parsedate", db_path, "example", "dt", "--db", db_path + "2", "--dry-run"],
+    )
+    assert result.exit_code == 1
+    assert "--dry-run and --sample can only be used with a single table" in (
+        result.output
+    )
+
+
+@pytest.mark.parametrize(
+    "args",
+    (
+        ["parsedate", "example", "dt"],
+        ["lambda", "example", "dt", "--code", "value.upper()"],
+        ["lambda", "example", "dt", "--multi", "--code", "{'upper': value.upper()}"],
+    ),
+)
+def test_dry_run_does_not_count_rows(test_db_and_path, monkeypatch, args):
+    # The preview only reads the first rows, so counting a large table would
+    # just slow it down
+    _, db_path = test_db_and_path
+
+    def count_rows(*args, **kwargs):
+        assert False, "Rows were counted"
+
+    monkeypatch.setattr(cli, "_count_rows", count_rows)
+    result = CliRunner().invoke(
+        cli.cli, args[:1] + [db_path] + args[1:] + ["--dry-run"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert " --- becomes:" in result.output
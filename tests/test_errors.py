@@ -0,0 +1,229 @@
+from click.testing import CliRunner
+from sqlite_transform import cli
+import pytest
+import time
+
+CODE = "return 100 // int(value)"
+
+
+@pytest.fixture
+def numbers_db_and_path(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["numbers"].insert_all(
+        [
+            {"id": 1, "n": "4"},
+            {"id": 2, "n": "0"},
+            {"id": 3, "n": "five"},
+            {"id": 4, "n": "0"},
+            {"id": 5, "n": None},
+        ],
+        pk="id",
+    )
+    return db, db_path
+
+
+MODES = (
+    [],
+    ["--dedupe"],
+    ["--batch-size", "2"],
+    ["--batch-size", "2", "--workers", "2"],
+)
+
+
+@pytest.mark.parametrize("options", MODES)
+@pytest.mark.parametrize(
+    "on_error,expected",
+    (
+        ("skip", ["25", "0", "five", "0", None]),
+        ("null", ["25", None, None, None, None]),
+        ("keep", ["25", "0", "five", "0", None]),
+    ),
+)
+def test_on_error(numbers_db_and_path, options, on_error, expected):
+    db, db_path = numbers_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "numbers", "n", "--code", CODE, "--on-error", on_error]
+        + options,
+    )
+    assert 0 == result.exit_code, result.output
+    assert "3 values could not be transformed" in result.output
+    assert [row["n"] for row in db["numbers"].rows] == expected
+    assert not db["errors"].exists()
+
+
+def test_on_error_keep_output(numbers_db_and_path):
+    db, db_path = numbers_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "numbers", "n", "--code", CODE]
+        + ["--on-error", "keep", "--output", "result"],
+    )
+    assert 0 == result.exit_code, result.output
+    # The original value is copied to the output column
+    assert [row["result"] for row in db["numbers"].rows] == [
+        "25",
+        "0",
+        "five",
+        "0",
+        None,
+    ]
+
+
+@pytest.mark.parametrize("options", MODES + (["--batch"],))
+def test_errors_table(numbers_db_and_path, options):
+    db, db_path = numbers_db_and_path
+    code = CODE
+    if "--batch" in options:
+        code = "return [100 // int(value) for value in values]"
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "numbers",
+            "n",
+            "--code",
+            code,
+            "--errors-table",
+            "errors",
+            "--output",
+            "result",
+        ]
+        + options,
+    )
+    assert 0 == result.exit_code, result.output
+    assert "3 values could not be transformed, see the errors table" in result.output
+    # --errors-table implies --on-error skip
+    assert [row["result"] for row in db["numbers"].rows] == [
+        "25",
+        None,
+        None,
+        None,
+        None,
+    ]
+    assert list(db.execute("select * from errors order by key")) == [
+        (
+            "numbers",
+            2,
+            "n",
+            "0",
+            "ZeroDivisionError: integer division or modulo by zero",
+        ),
+        (
+            "numbers",
+            3,
+            "n",
+            "five",
+            "ValueError: invalid literal for int() with base 10: 'five'",
+        ),
+        (
+            "numbers",
+            4,
+            "n",
+            "0",
+            "ZeroDivisionError: integer division or modulo by zero",
+        ),
+    ]
+    # Fixing the code and rerunning against only the failed rows
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "numbers",
+            "n",
+            "--code",
+            "return -1",
+            "--output",
+            "result",
+            "--where",
+            "rowid in (select key from errors where [table] = 'numbers')",
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["result"] for row in db["numbers"].rows] == [
+        "25",
+        "-1",
+        "-1",
+        "-1",
+        None,
+    ]
+
+
+def test_errors_table_multi(numbers_db_and_path):
+    db, db_path = numbers_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "numbers",
+            "n",
+            "--multi",
+            "--code",
+            "{'half': 100 // int(value)}",
+            "--errors-table",
+            "errors",
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["half"] for row in db["numbers"].rows] == [25, None, None, None, None]
+    # The None value raises a TypeError in this code too
+    assert [(row["key"], row["value"]) for row in db.query("select * from errors")] == [
+        (2, "0"),
+        (3, "five"),
+        (4, "0"),
+        (5, None),
+    ]
+
+
+def test_errors_table_without_rowid(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db.execute("create table codes (code text primary key, n text) without rowid")
+    db["codes"].insert_all([{"code": "a", "n": "2"}, {"code": "b", "n": "x"}])
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "codes", "n", "--code", CODE, "--errors-table", "errors"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert list(db.execute("select key, value from errors")) == [("b", "x")]
+    assert list(db.execute("select code, n from codes order by code")) == [
+        ("a", "50"),
+        ("b", "x"),
+    ]
+
+
+def test_on_error_sql_pushdown(numbers_db_and_path):
+    _, db_path = numbers_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["parsedate", db_path, "numbers", "n", "--sql-pushdown", "--on-error", "skip"],
+    )
+    assert result.exit_code == 1
+    assert (
+        "--sql-pushdown cannot be used with --on-error or --errors-table"
+        in result.output
+    )
+
+
+def test_on_error_async(numbers_db_and_path, tmpdir):
+    db, db_path = numbers_db_and_path
+    calls_path = str(tmpdir / "calls.txt")
+    code = (
+        "open({!r}, 'a').write(value + '\\n')\n"
+        "await asyncio.sleep(0.1)\n"
+        "return 100 // int(value)"
+    ).format(calls_path)
+    start = time.perf_counter()
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "numbers", "n", "--async", "--import", "asyncio"]
+        + ["--code", code, "--errors-table", "errors"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["n"] for row in db["numbers"].rows] == ["25", "0", "five", "0", None]
+    assert [row["key"] for row in db["errors"].rows] == [2, 3, 4]
+    # Each value was transformed once, with the calls running at once
+    assert sorted(open(calls_path).read().split()) == ["0", "0", "4", "five"]
+    assert time.perf_counter() - start < 0.35
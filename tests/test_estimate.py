@@ -0,0 +1,81 @@
+from click.testing import CliRunner
+import json
+import pytest
+from sqlite_transform import cli
+
+
+@pytest.fixture
+def gappy_db_and_path(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["t"].insert_all(
+        [{"id": i, "v": "a,b" if i % 2 else None} for i in range(1, 101)], pk="id"
+    )
+    with db.conn:
+        db.execute("delete from t where id > 10 and id < 91")
+    return db, db_path
+
+
+def test_estimate_from_rowids(gappy_db_and_path):
+    db, _ = gappy_db_and_path
+    assert cli._count_rows(db, "t") == 20
+    assert cli._count_rows(db, "t", estimate=True) == 100
+    # A where clause is ignored by the estimate
+    assert cli._count_rows(db, "t", "id > :n", {"n": 95}, estimate=True) == 100
+
+
+def test_estimate_from_sqlite_stat1(gappy_db_and_path):
+    db, _ = gappy_db_and_path
+    db["t"].create_index(["v"])
+    db.execute("analyze")
+    assert cli._count_rows(db, "t", estimate=True) == 20
+
+
+def test_estimate_without_rowid(fresh_db_and_path):
+    db, _ = fresh_db_and_path
+    db.execute("create table t (id text primary key, v text) without rowid")
+    assert cli._count_rows(db, "t", estimate=True) == 0
+    db["t"].insert_all([{"id": str(i), "v": "x" * 100} for i in range(1000)])
+    estimate = cli._count_rows(db, "t", estimate=True)
+    assert 500 < estimate < 10000
+
+
+@pytest.mark.parametrize(
+    "options",
+    (
+        [],
+        ["--batch-size", "3"],
+        ["--dedupe"],
+        ["--sql-pushdown"],
+        ["--where", "id > 5"],
+        ["--batch-size", "3", "--where", "id > 5"],
+    ),
+)
+def test_estimate_count_progress(gappy_db_and_path, options):
+    db, db_path = gappy_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["jsonsplit", db_path, "t", "v", "--estimate-count", "--progress-json"]
+        + options,
+    )
+    assert 0 == result.exit_code, result.output
+    lines = [json.loads(line) for line in result.output.splitlines()]
+    expected = 15 if "--where" in options else 20
+    assert lines[-1]["done"]
+    assert lines[-1]["n"] == lines[-1]["total"] == expected
+    assert db["t"].get(99)["v"] == '["a", "b"]'
+
+
+def test_estimate_count_multi(gappy_db_and_path):
+    db, db_path = gappy_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "t", "v", "--multi", "--estimate-count"]
+        + ["--progress-json", "--code", "{'first': value[0]} if value else None"],
+    )
+    assert 0 == result.exit_code, result.output
+    lines = [json.loads(line) for line in result.output.splitlines()]
+    assert [(line["desc"], line["n"], line["total"]) for line in lines] == [
+        ("1: Evaluating", 20, 20),
+        ("2: Updating", 10, 10),
+    ]
+    assert db["t"].get(1)["first"] == "a"
@@ -1,6 +1,7 @@
 from click.testing import CliRunner
 from sqlite_transform import cli
 import textwrap
+import time
 import pytest
 
 
@@ -317,3 +318,199 @@ def test_lambda_multi_complex_column_types(fresh_db_and_path):
         "   [id] INTEGER PRIMARY KEY\n"
         ", [is_str] TEXT, [is_float] FLOAT, [is_int] INTEGER, [is_bytes] BLOB)"
     )
+
+
+def test_lambda_multi_spills_in_batches(fresh_db_and_path, monkeypatch):
+    monkeypatch.setattr(cli, "MULTI_SPILL_BATCH_SIZE", 2)
+    db, db_path = fresh_db_and_path
+    db["places"].insert_all(
+        [
+            {"country": "uk", "id": i, "location": "{},{}".format(i, i * 2)}
+            for i in range(1, 6)
+        ],
+        pk=("country", "id"),
+    )
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "places",
+            "location",
+            "--multi",
+            "--code",
+            'dict(zip(("lat", "lng", "both"), value.split(",") + [value.split(",")]))',
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert list(db.execute("select id, lat, lng, both from places")) == [
+        (i, str(i), str(i * 2), '["{}", "{}"]'.format(i, i * 2)) for i in range(1, 6)
+    ]
+
+
+@pytest.mark.parametrize("batch_size", (None, 1, 2, 10))
+def test_lambda_multi_batch_size(fresh_db_and_path, batch_size):
+    db, db_path = fresh_db_and_path
+    db["creatures"].insert_all(
+        [{"name": name} for name in ("Simon", "Cleo", "Azi", "Pancakes", "")]
+    )
+    args = [
+        "lambda",
+        db_path,
+        "creatures",
+        "name",
+        "--multi",
+        "--code",
+        # Rows return different sets of keys
+        '{"upper": value.upper(), "len": len(value)} if len(value) < 5 '
+        'else {"lower": value.lower()}',
+    ]
+    if batch_size:
+        args += ["--batch-size", str(batch_size)]
+    result = CliRunner().invoke(cli.cli, args)
+    assert result.exit_code == 0, result.output
+    assert list(db["creatures"].rows) == [
+        {"name": "Simon", "lower": "simon", "upper": None, "len": None},
+        {"name": "Cleo", "lower": None, "upper": "CLEO", "len": 4},
+        {"name": "Azi", "lower": None, "upper": "AZI", "len": 3},
+        {"name": "Pancakes", "lower": "pancakes", "upper": None, "len": None},
+        {"name": "", "lower": None, "upper": "", "len": 0},
+    ]
+
+
+@pytest.mark.parametrize(
+    "options", ([], ["--batch-size", "1"], ["--workers", "2", "--batch-size", "2"])
+)
+def test_lambda_batch(test_db_and_path, options):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "example",
+            "dt",
+            "--batch",
+            "--code",
+            "[v.upper() + ' ' + str(len(values)) for v in values]",
+        ]
+        + options,
+    )
+    assert 0 == result.exit_code, result.output
+    # Empty and null values are not passed to the code
+    size = 1 if options else 2
+    assert [
+        {"id": 1, "dt": "5TH OCTOBER 2019 12:04 {}".format(size)},
+        {"id": 2, "dt": "6TH OCTOBER 2019 00:05:06 {}".format(size)},
+        {"id": 3, "dt": ""},
+        {"id": 4, "dt": None},
+    ] == list(db["example"].rows)
+
+
+def test_lambda_batch_dry_run(test_db_and_path):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "example",
+            "dt",
+            "--batch",
+            "--code",
+            "[str(len(values))] * len(values)",
+            "--dry-run",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output.split("\n")[:3] == [
+        "5th October 2019 12:04",
+        " --- becomes:",
+        "2",
+    ]
+
+
+def test_lambda_batch_wrong_length(test_db_and_path):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "example", "dt", "--batch", "--code", "values[:1]"],
+    )
+    assert result.exit_code == 1
+    assert (
+        "With --batch code must return a list with one result per value - "
+        "returned 1 results for 2 values"
+    ) in result.output
+
+
+@pytest.mark.parametrize("options", ([], ["--workers", "2"]))
+def test_lambda_async(fresh_db_and_path, options):
+    db, db_path = fresh_db_and_path
+    db["example"].insert_all(
+        [{"id": i, "name": "name{}".format(i)} for i in range(20)] + [{"id": 20}],
+        pk="id",
+    )
+    start = time.perf_counter()
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "example",
+            "name",
+            "--async",
+            "--concurrency",
+            "20",
+            "--import",
+            "asyncio",
+            "--code",
+            "await asyncio.sleep(0.1)\nreturn value.upper()",
+        ]
+        + options,
+    )
+    assert 0 == result.exit_code, result.output
+    # 20 calls to sleep(0.1) would take 2s if they ran one at a time
+    assert time.perf_counter() - start < 1.5
+    assert [row["name"] for row in db["example"].rows] == [
+        "NAME{}".format(i) for i in range(20)
+    ] + [None]
+
+
+def test_lambda_async_dry_run(test_db_and_path):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "example",
+            "dt",
+            "--async",
+            "--code",
+            "value.upper()",
+            "--dry-run",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output.split("\n")[:3] == [
+        "5th October 2019 12:04",
+        " --- becomes:",
+        "5TH OCTOBER 2019 12:04",
+    ]
+
+
+@pytest.mark.parametrize(
+    "options,expected_error",
+    (
+        (["--batch"], "Cannot use --batch with --async"),
+        (["--multi"], "Cannot use --batch or --async with --multi"),
+    ),
+)
+def test_lambda_async_errors(test_db_and_path, options, expected_error):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "example", "dt", "--async", "--code", "value"] + options,
+    )
+    assert result.exit_code == 1
+    assert expected_error in result.output
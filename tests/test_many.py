@@ -0,0 +1,119 @@
+from click.testing import CliRunner
+from sqlite_transform import cli
+import pathlib
+import pytest
+import sqlite_utils
+
+
+@pytest.fixture
+def shards(tmpdir):
+    paths = []
+    for i in range(3):
+        path = str(pathlib.Path(tmpdir) / "shard{}.db".format(i))
+        db = sqlite_utils.Database(path)
+        for table in ("one", "two"):
+            db[table].insert_all(
+                [{"id": j, "tags": "{},{}".format(i, j)} for j in range(5)], pk="id"
+            )
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize("jobs", (1, 2))
+def test_glob_and_tables(shards, jobs):
+    pattern = str(pathlib.Path(shards[0]).parent / "shard*.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["jsonsplit", pattern, "one", "tags", "--table", "two", "--jobs", str(jobs)],
+    )
+    assert 0 == result.exit_code, result.output
+    for i, path in enumerate(shards):
+        db = sqlite_utils.Database(path)
+        for table in ("one", "two"):
+            assert [row["tags"] for row in db[table].rows] == [
+                '["{}", "{}"]'.format(i, j) for j in range(5)
+            ]
+        assert "{} one: 5 values in".format(path) in result.output
+    assert "Transformed 30 values in 6 tables in" in result.output
+
+
+def test_db_option(shards):
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", shards[0], "one", "tags", "--db", shards[2], "--silent"]
+        + ["--code", "value.upper() + '!'"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert result.output == ""
+    assert [sqlite_utils.Database(path)["one"].get(1)["tags"] for path in shards] == [
+        "0,1!",
+        "1,1",
+        "2,1!",
+    ]
+
+
+def test_multi_many(shards):
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", shards[0], "one", "tags", "--db", shards[1], "--multi"]
+        + ["--code", "dict(zip(('a', 'b'), value.split(',')))", "--jobs", "2"],
+    )
+    assert 0 == result.exit_code, result.output
+    for i in (0, 1):
+        assert sqlite_utils.Database(shards[i])["one"].get(3) == {
+            "id": 3,
+            "tags": "{},3".format(i),
+            "a": str(i),
+            "b": "3",
+        }
+
+
+def test_failed_table_reported(shards):
+    sqlite_utils.Database(shards[1])["two"].drop()
+    pattern = str(pathlib.Path(shards[0]).parent / "shard*.db")
+    result = CliRunner().invoke(
+        cli.cli, ["jsonsplit", pattern, "one", "tags", "--table", "two"]
+    )
+    assert result.exit_code == 1
+    assert "{} two: failed - ".format(shards[1]) in result.output
+    assert "Transformed 25 values in 5 tables in" in result.output
+    assert "Error: 1 of 6 tables failed" in result.output
+    # The other tables were still transformed
+    assert sqlite_utils.Database(shards[2])["two"].get(0)["tags"] == '["2", "0"]'
+
+
+def test_glob_matches_nothing(tmpdir):
+    result = CliRunner().invoke(
+        cli.cli, ["jsonsplit", str(pathlib.Path(tmpdir) / "*.db"), "t", "c"]
+    )
+    assert result.exit_code == 1
+    assert "No database files match" in result.output
+
+
+def test_profile_needs_single_table(shards):
+    result = CliRunner().invoke(
+        cli.cli, ["jsonsplit", shards[0], "one", "tags", "--table", "two", "--profile"]
+    )
+    assert result.exit_code == 1
+    assert "--profile and --stats-json can only be used with a single table" in (
+        result.output
+    )
+
+
+def test_jobs_one_process_per_database(shards, tmpdir):
+    # Tables in the same file are transformed by the same process, so they
+    # never compete for the file's write lock
+    pids_path = str(pathlib.Path(tmpdir) / "pids.txt")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", shards[0], "one", "tags", "--table", "two", "--jobs", "2"]
+        + ["--import", "os", "--code"]
+        + [
+            "open({!r}, 'a').write(str(os.getpid()) + '\\n') and value".format(
+                pids_path
+            )
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    assert "Transformed 10 values in 2 tables in" in result.output
+    assert len(set(open(pids_path).read().split())) == 1
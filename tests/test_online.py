@@ -0,0 +1,144 @@
+from click.testing import CliRunner
+from sqlite_transform import cli
+import json
+import pathlib
+import pytest
+import sqlite3
+import threading
+
+
+@pytest.fixture
+def words_db_and_path(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["words"].insert_all(
+        [{"id": i, "word": "word{}".format(i)} for i in range(1, 6)], pk="id"
+    )
+    return db, db_path
+
+
+def test_online(words_db_and_path):
+    db, db_path = words_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "words", "word", "--code", "value.upper()", "--online"]
+        + ["--batch-size", "2", "--rate", "1000", "--duty-cycle", "0.9"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["word"] for row in db["words"].rows] == [
+        "WORD1",
+        "WORD2",
+        "WORD3",
+        "WORD4",
+        "WORD5",
+    ]
+    assert not db[cli.PROGRESS_TABLE].exists()
+    # The busy timeout is put back afterwards
+    assert db.execute("pragma busy_timeout").fetchone()[0] == 5000
+
+
+def test_online_leaves_concurrent_changes(words_db_and_path):
+    db, db_path = words_db_and_path
+    # The code changes word2 from another connection after it has been read
+    code = (
+        "if value == 'word1':\n"
+        "    conn = sqlite3.connect({!r})\n"
+        "    conn.execute(\"update words set word = 'changed' where id = 2\")\n"
+        "    conn.commit()\n"
+        "    conn.close()\n"
+        "return value.upper()"
+    ).format(db_path)
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "words", "word", "--code", code, "--import", "sqlite3"]
+        + ["--online"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["word"] for row in db["words"].rows] == [
+        "WORD1",
+        "changed",
+        "WORD3",
+        "WORD4",
+        "WORD5",
+    ]
+
+
+def test_online_backs_off_while_locked(words_db_and_path, tmpdir):
+    db, db_path = words_db_and_path
+    stats_path = str(pathlib.Path(tmpdir) / "stats.json")
+    other = sqlite3.connect(db_path, check_same_thread=False)
+    other.execute("begin immediate")
+    timer = threading.Timer(0.3, other.commit)
+    timer.start()
+    try:
+        result = CliRunner().invoke(
+            cli.cli,
+            ["lambda", db_path, "words", "word", "--code", "value.upper()"]
+            + ["--online", "--busy-timeout", "0", "--stats-json", stats_path],
+        )
+    finally:
+        timer.join()
+    assert 0 == result.exit_code, result.output
+    assert [row["word"] for row in db["words"].rows][0] == "WORD1"
+    assert json.load(open(stats_path))["busy_retries"] > 0
+
+
+def test_online_gives_up(words_db_and_path, monkeypatch):
+    db, db_path = words_db_and_path
+    monkeypatch.setattr(cli.Throttle, "MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(cli.Throttle, "BACKOFF_START", 0.01)
+    other = sqlite3.connect(db_path)
+    other.execute("begin immediate")
+    try:
+        result = CliRunner().invoke(
+            cli.cli,
+            ["lambda", db_path, "words", "word", "--code", "value.upper()"]
+            + ["--online", "--busy-timeout", "0"],
+        )
+    finally:
+        other.rollback()
+    assert result.exit_code == 1
+    assert "Database was still locked after 2 attempts" in result.output
+    assert [row["word"] for row in db["words"].rows][0] == "word1"
+
+
+@pytest.mark.parametrize(
+    "rate,duty_cycle,rows,busy_seconds,expected",
+    (
+        (None, 0.25, 10, 1.0, 3.0),
+        (None, 1.0, 10, 1.0, None),
+        (10, None, 50, 0.1, 5.0),
+        (10, 0.5, 50, 6.0, 6.0),
+    ),
+)
+def test_throttle_pause(monkeypatch, rate, duty_cycle, rows, busy_seconds, expected):
+    sleeps = []
+    monkeypatch.setattr(cli.time, "sleep", sleeps.append)
+    throttle = cli.Throttle(True, rate, duty_cycle)
+    throttle.pause(rows, busy_seconds, cli.RunStats())
+    if expected is None:
+        assert sleeps == []
+    else:
+        assert sleeps == [pytest.approx(expected, abs=0.05)]
+
+
+@pytest.mark.parametrize(
+    "options,error",
+    (
+        (
+            ["--rate", "10"],
+            "--busy-timeout, --rate and --duty-cycle can only be used with --online",
+        ),
+        (["--online", "--rate", "0"], "--rate must be greater than 0"),
+        (
+            ["--online", "--dedupe"],
+            "--online cannot be used with --dedupe, --sql-pushdown or --output-db",
+        ),
+    ),
+)
+def test_online_errors(words_db_and_path, options, error):
+    _, db_path = words_db_and_path
+    result = CliRunner().invoke(
+        cli.cli, ["jsonsplit", db_path, "words", "word"] + options
+    )
+    assert result.exit_code == 1
+    assert error in result.output
@@ -0,0 +1,204 @@
+from click.testing import CliRunner
+from sqlite_transform import cli
+import pathlib
+import pytest
+import sqlite3
+import sqlite_utils
+
+
+@pytest.fixture
+def output_db_and_path(tmpdir):
+    db_path = str(pathlib.Path(tmpdir) / "output.db")
+    return sqlite_utils.Database(db_path), db_path
+
+
+@pytest.mark.parametrize(
+    "options",
+    ([], ["--batch-size", "1"], ["--workers", "2"], ["--output", "parsed"]),
+)
+def test_output_db(test_db_and_path, output_db_and_path, options):
+    db, db_path = test_db_and_path
+    out, out_path = output_db_and_path
+    before = list(db["example"].rows)
+    # Readers and even a pending write on the source don't get in the way
+    other = sqlite3.connect(db_path)
+    other.execute("begin immediate")
+    try:
+        result = CliRunner().invoke(
+            cli.cli,
+            ["parsedate", db_path, "example", "dt", "--output-db", out_path] + options,
+        )
+    finally:
+        other.rollback()
+    assert 0 == result.exit_code, result.output
+    assert list(db["example"].rows) == before
+    assert db.table_names() == ["example"]
+    output = "parsed" if "--output" in options else "dt"
+    assert list(out.execute("select * from example")) == [
+        (1, "2019-10-05"),
+        (2, "2019-10-06"),
+        (3, ""),
+        (4, None),
+    ]
+    assert out["example"].columns_dict == {"rowid": int, output: str}
+
+
+def test_output_db_resume_and_merge(fresh_db_and_path, output_db_and_path):
+    db, db_path = fresh_db_and_path
+    out, out_path = output_db_and_path
+    db["example"].insert_all(
+        [{"id": i, "name": "name{}".format(i)} for i in range(1, 6)], pk="id"
+    )
+    args = ["lambda", db_path, "example", "name", "--output-db", out_path]
+    args += ["--batch-size", "2", "--import", "os", "--code"]
+    args += [
+        "assert not (value == 'name4' and os.environ.get('FAIL'))\nreturn value + '!'"
+    ]
+    # The first run fails on the fourth row, after committing two rows
+    result = CliRunner().invoke(cli.cli, args, env={"FAIL": "1"})
+    assert isinstance(result.exception, AssertionError)
+    assert list(out.execute("select rowid, name from example")) == [
+        (1, "name1!"),
+        (2, "name2!"),
+    ]
+    # The second run picks up after the last row written
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    assert [row["name"] for row in out["example"].rows] == [
+        "name1!",
+        "name2!",
+        "name3!",
+        "name4!",
+        "name5!",
+    ]
+    assert [row["name"] for row in db["example"].rows][0] == "name1"
+    # Merging the results back in is one UPDATE
+    db.execute("attach ? as results", [out_path])
+    with db.conn:
+        db.execute(
+            "update main.example set name = r.name "
+            "from results.example as r where r.rowid = main.example.rowid"
+        )
+    assert [row["name"] for row in db["example"].rows] == [
+        "name1!",
+        "name2!",
+        "name3!",
+        "name4!",
+        "name5!",
+    ]
+
+
+@pytest.mark.parametrize(
+    "options,error",
+    (
+        (
+            ["--code", "value + '?'"],
+            "Table example in --output-db holds results from a different "
+            "transform - delete it to start again",
+        ),
+        (
+            ["--code", "value.upper()", "--where", "rowid > 2"],
+            "Table example in --output-db holds results from a different "
+            "transform - delete it to start again",
+        ),
+        (
+            ["--code", "value.upper()", "--output", "w"],
+            "Table example in --output-db has columns rowid, dt, not rowid, w",
+        ),
+    ),
+)
+def test_output_db_different_transform(
+    test_db_and_path, output_db_and_path, options, error
+):
+    _, db_path = test_db_and_path
+    out, out_path = output_db_and_path
+    args = ["lambda", db_path, "example", "dt", "--output-db", out_path]
+    result = CliRunner().invoke(cli.cli, args + ["--code", "value.upper()"])
+    assert 0 == result.exit_code, result.output
+    before = list(out["example"].rows)
+    result = CliRunner().invoke(cli.cli, args + options)
+    assert result.exit_code == 1
+    assert error in result.output
+    assert list(out["example"].rows) == before
+
+
+def test_output_db_errors_table(test_db_and_path, output_db_and_path):
+    db, db_path = test_db_and_path
+    out, out_path = output_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "example", "dt", "--output-db", out_path]
+        + ["--code", "int(value)", "--errors-table", "errors"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert not db["errors"].exists()
+    assert [row["key"] for row in out["errors"].rows] == [1, 2]
+    # Failed values keep their original value, as with --on-error skip
+    assert [row["dt"] for row in out["example"].rows][:2] == [
+        "5th October 2019 12:04",
+        "6th October 2019 00:05:06",
+    ]
+
+
+@pytest.mark.parametrize("options", ([], ["--async"], ["--workers", "2"]))
+def test_output_db_errors_table_modes(test_db_and_path, output_db_and_path, options):
+    # Shares its batch loop with --batch-size, so handles errors the same way
+    _, db_path = test_db_and_path
+    out, out_path = output_db_and_path
+    code = "int(value)"
+    if "--async" in options:
+        code = "await asyncio.sleep(0)\nreturn int(value)"
+        options = options + ["--import", "asyncio"]
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "example", "dt", "--output-db", out_path]
+        + ["--code", code, "--errors-table", "errors"]
+        + options,
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["key"] for row in out["errors"].rows] == [1, 2]
+    assert out["example"].count == 4
+
+
+def test_output_db_without_rowid(fresh_db_and_path, output_db_and_path):
+    db, db_path = fresh_db_and_path
+    out, out_path = output_db_and_path
+    db.execute("create table example (code text primary key, tags text) without rowid")
+    db["example"].insert_all([{"code": "b", "tags": "1,2"}, {"code": "a", "tags": "3"}])
+    result = CliRunner().invoke(
+        cli.cli,
+        ["jsonsplit", db_path, "example", "tags", "--output-db", out_path],
+    )
+    assert 0 == result.exit_code, result.output
+    assert list(out.execute("select code, tags from example")) == [
+        ("a", '["3"]'),
+        ("b", '["1", "2"]'),
+    ]
+
+
+@pytest.mark.parametrize(
+    "options,error",
+    (
+        (
+            ["--output", "other", "--drop"],
+            "--output-db cannot be used with --drop, --dedupe or --sql-pushdown",
+        ),
+        (
+            ["--dedupe"],
+            "--output-db cannot be used with --drop, --dedupe or --sql-pushdown",
+        ),
+        (
+            ["--table", "example", "--db", "other.db"],
+            "--output-db can only be used with a single database and no --jobs",
+        ),
+    ),
+)
+def test_output_db_errors(test_db_and_path, output_db_and_path, options, error):
+    _, db_path = test_db_and_path
+    _, out_path = output_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["parsedate", db_path, "example", "dt", "--output-db", out_path] + options,
+    )
+    assert result.exit_code == 1
+    assert error in result.output
@@ -94,3 +94,93 @@ def test_parsedatetime_output_drop(test_db_and_path):
         {"id": 3, "parsed": ""},
         {"id": 4, "parsed": None},
     ]
+
+
+@pytest.mark.parametrize(
+    "values,options,expected",
+    (
+        (["2019-10-05", "2019-10-06 10:11:12"], {}, ("%Y-%m-%d", "%Y-%m-%d %H:%M:%S")),
+        (["10/10/2019 08:10:00 PM"], {}, ("%m/%d/%Y %I:%M:%S %p",)),
+        (["04/10/2019", "04/11/2019", "13/11/2019"], {}, ("%m/%d/%Y",)),
+        (["04/10/2019", "04/11/2019"], {"dayfirst": True}, ("%d/%m/%Y",)),
+        # dateutil with dayfirst swaps the month and day in ISO dates too
+        (["2019-10-05"], {"dayfirst": True}, ()),
+        # Only the day can be above 12, but later values might be ambiguous
+        (["13/04/2020", "25/12/2020"], {}, ()),
+        (["04/13/2020", "12/25/2020"], {"dayfirst": True}, ()),
+        (["13/04/2020", "25/12/2020"], {"dayfirst": True}, ("%d/%m/%Y",)),
+        (["5th October 2019 12:04", "", None, 3], {}, ()),
+    ),
+)
+def test_infer_date_formats(fresh_db_and_path, values, options, expected):
+    db, db_path = fresh_db_and_path
+    db["example"].insert_all([{"dt": value} for value in values])
+    formats = cli._infer_date_formats(
+        db_path,
+        "example",
+        ["dt"],
+        options.get("dayfirst", False),
+        options.get("yearfirst", False),
+    )
+    assert formats == expected
+
+
+@pytest.mark.parametrize(
+    "options,expected",
+    (
+        ([], ["2020-04-13", "2020-12-25", "2020-03-04"]),
+        (["--dayfirst"], ["2020-04-13", "2020-12-25", "2020-04-03"]),
+    ),
+)
+def test_inferred_formats_respect_dayfirst(
+    fresh_db_and_path, monkeypatch, options, expected
+):
+    db, db_path = fresh_db_and_path
+    # The ambiguous date is outside the sample formats are inferred from
+    monkeypatch.setattr(cli, "DATE_FORMATS_SAMPLE_SIZE", 2)
+    db["example"].insert_all(
+        [{"dt": "13/04/2020"}, {"dt": "25/12/2020"}, {"dt": "03/04/2020"}]
+    )
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "example", "dt"] + options
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["dt"] for row in db["example"].rows] == expected
+
+
+@pytest.mark.parametrize(
+    "command,expected",
+    (
+        ("parsedate", ["2019-03-04", "2019-05-06", "2019-10-05"]),
+        (
+            "parsedatetime",
+            ["2019-03-04T10:00:00", "2019-05-06T00:00:00", "2019-10-05T12:04:00"],
+        ),
+    ),
+)
+def test_format(fresh_db_and_path, command, expected):
+    db, db_path = fresh_db_and_path
+    db["example"].insert_all(
+        [
+            {"id": 1, "dt": "2019.03.04 10:00"},
+            {"id": 2, "dt": "2019.05.06"},
+            # Values that match neither format fall back to dateutil
+            {"id": 3, "dt": "5th October 2019 12:04"},
+        ],
+        pk="id",
+    )
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            command,
+            db_path,
+            "example",
+            "dt",
+            "--format",
+            "%Y.%m.%d %H:%M",
+            "--format",
+            "%Y.%m.%d",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert [row["dt"] for row in db["example"].rows] == expected
@@ -0,0 +1,134 @@
+from click.testing import CliRunner
+from sqlite_transform import cli, Pipeline
+import json
+import pathlib
+import pytest
+
+
+@pytest.fixture
+def articles(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["articles"].insert_all(
+        [
+            {"id": 1, "created": "5th October 2019", "tags": "1,2", "title": " A "},
+            {"id": 2, "created": "6th October 2019", "tags": "3", "title": "B  "},
+            {"id": 3, "created": None, "tags": "", "title": None},
+        ],
+        pk="id",
+    )
+    return db, db_path
+
+
+EXPECTED = [
+    {"id": 1, "created": "2019-10-05", "tags": "[1, 2]", "title": "a"},
+    {"id": 2, "created": "2019-10-06", "tags": "[3]", "title": "b"},
+    {"id": 3, "created": None, "tags": "", "title": None},
+]
+
+
+@pytest.mark.parametrize("options", ({}, {"batch_size": 2}, {"workers": 2}))
+def test_pipeline(articles, options):
+    db, db_path = articles
+    count = (
+        Pipeline()
+        .parsedate("created")
+        .jsonsplit("tags", type="int")
+        .lambda_("title", "value.strip().lower()")
+        .run(db, "articles", **options)
+    )
+    assert count == 9
+    assert list(db["articles"].rows) == EXPECTED
+
+
+def test_pipeline_single_update(articles):
+    db, db_path = articles
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    Pipeline().parsedate("created").jsonsplit("tags").run(db, "articles")
+    assert [sql for sql in statements if sql.startswith("update")] == [
+        "update [articles] set "
+        "[created] = transform_result(rowid, 0, [created], [created]), "
+        "[tags] = transform_result(rowid, 1, [tags], [tags]) "
+        "where transform_row(rowid, [created], [created], [tags], [tags]);"
+    ]
+
+
+def test_pipeline_low_cardinality_single_update(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["articles"].insert_all(
+        [
+            {"id": i, "created": "{}th October 2019".format(5 + i % 2), "tags": "1,2"}
+            for i in range(100)
+        ],
+        pk="id",
+    )
+    db.execute("create table writes (id integer)")
+    db.execute(
+        "create trigger count_writes after update on articles "
+        "begin insert into writes values (new.id); end"
+    )
+    Pipeline().parsedate("created").jsonsplit("tags").run(db, "articles")
+    assert db["writes"].count == 100
+    assert db["articles"].get(1) == {
+        "id": 1,
+        "created": "2019-10-06",
+        "tags": '["1", "2"]',
+    }
+
+
+def test_pipeline_outputs_and_drop(articles):
+    db, db_path = articles
+    Pipeline().parsedate("created", output="day").parsedatetime(
+        "created", output="timestamp"
+    ).run(db_path, "articles", drop=True, where="id = :id", params={"id": 1})
+    assert db["articles"].get(1) == {
+        "id": 1,
+        "tags": "1,2",
+        "title": " A ",
+        "day": "2019-10-05",
+        "timestamp": "2019-10-05T00:00:00",
+    }
+    assert db["articles"].get(2)["day"] is None
+
+
+def test_pipeline_duplicate_output():
+    with pytest.raises(cli.click.ClickException) as ex:
+        Pipeline().parsedate("created").jsonsplit("tags", output="created")
+    assert ex.value.message == "More than one step writes to column created"
+
+
+@pytest.mark.parametrize("extension", ("json", "yml"))
+def test_run_spec(articles, tmpdir, extension):
+    db, db_path = articles
+    steps = [
+        {"parsedate": "created", "format": "%dth %B %Y"},
+        {"jsonsplit": "tags", "type": "int"},
+        {"lambda": "title", "code": "value.strip().lower()"},
+    ]
+    spec_path = pathlib.Path(tmpdir) / "spec.{}".format(extension)
+    dumps = json.dumps
+    if extension == "yml":
+        dumps = pytest.importorskip("yaml").safe_dump
+    spec_path.write_text(dumps({"table": "articles", "steps": steps}))
+    result = CliRunner().invoke(cli.cli, ["run", db_path, str(spec_path)])
+    assert 1 == result.exit_code
+    assert "Invalid parsedate step" in result.output
+    steps[0]["formats"] = steps[0].pop("format")
+    spec_path.write_text(dumps({"table": "articles", "steps": steps}))
+    result = CliRunner().invoke(cli.cli, ["run", db_path, str(spec_path)])
+    assert 0 == result.exit_code, result.output
+    assert list(db["articles"].rows) == EXPECTED
+
+
+def test_run_spec_needs_table(articles, tmpdir):
+    db, db_path = articles
+    spec_path = pathlib.Path(tmpdir) / "spec.json"
+    spec_path.write_text(json.dumps([{"jsonsplit": "tags"}]))
+    result = CliRunner().invoke(cli.cli, ["run", db_path, str(spec_path)])
+    assert 1 == result.exit_code
+    assert "Spec needs a table, or use --table" in result.output
+    result = CliRunner().invoke(
+        cli.cli, ["run", db_path, str(spec_path), "--table", "articles"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert db["articles"].get(1)["tags"] == '["1", "2"]'
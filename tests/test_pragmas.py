@@ -0,0 +1,72 @@
+from click.testing import CliRunner
+from sqlite_transform import cli
+import pytest
+import sqlite_utils
+
+
+def _settings(db):
+    return {
+        name: db.execute("pragma {}".format(name)).fetchone()[0]
+        for name in cli.FAST_PRAGMAS
+    }
+
+
+def test_pragmas_restored(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["t"].insert({"id": 1})
+    before = _settings(db)
+    with cli._pragmas(db, fast=True, pragmas=["synchronous=off"]):
+        assert _settings(db) == {
+            "journal_mode": "wal",
+            "synchronous": 0,
+            "cache_size": -262144,
+            "mmap_size": 1024 * 1024 * 1024,
+        }
+        # Temporary tables can be larger than memory
+        assert db.execute("pragma temp_store").fetchone()[0] == 0
+    assert _settings(db) == before
+
+
+@pytest.mark.parametrize(
+    "options",
+    (
+        ["--fast"],
+        ["--fast", "--batch-size", "2"],
+        ["--pragma", "journal_mode=off", "--pragma", "synchronous=OFF"],
+    ),
+)
+def test_fast(test_db_and_path, options):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "example", "dt"] + options
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["dt"] for row in db["example"].rows] == [
+        "2019-10-05",
+        "2019-10-06",
+        "",
+        None,
+    ]
+    assert sqlite_utils.Database(db_path).journal_mode == "delete"
+
+
+def test_fast_multi(test_db_and_path):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "example", "dt", "--multi", "--fast"]
+        + ["--code", "{'length': len(value)} if value else None"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert db["example"].get(1)["length"] == 22
+    assert sqlite_utils.Database(db_path).journal_mode == "delete"
+
+
+@pytest.mark.parametrize("pragma", ("synchronous", "synchronous=1; drop table t"))
+def test_invalid_pragma(test_db_and_path, pragma):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "example", "dt", "--pragma", pragma]
+    )
+    assert result.exit_code == 1
+    assert "--pragma should look like name=value" in result.output
@@ -0,0 +1,101 @@
+from click.testing import CliRunner
+import json
+import pytest
+from sqlite_transform import cli
+
+
+@pytest.mark.parametrize(
+    "options,expected_calls",
+    (
+        ([], 2),
+        (["--batch-size", "2"], 2),
+        (["--workers", "2"], 2),
+        (["--dedupe"], 2),
+    ),
+)
+def test_stats_json(test_db_and_path, tmpdir, options, expected_calls):
+    db, db_path = test_db_and_path
+    stats_path = str(tmpdir / "stats.json")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["parsedate", db_path, "example", "dt", "--stats-json", stats_path] + options,
+    )
+    assert 0 == result.exit_code, result.output
+    stats = json.load(open(stats_path))
+    assert stats["values_scanned"] == 4
+    assert stats["values_skipped"] == 2
+    assert stats["fn_calls"] == expected_calls
+    assert stats["values_changed"] == 2
+    assert stats["errors"] == 0
+    assert set(stats["timings"]) >= {"fn", "sql", "commit", "other"}
+    assert all(seconds >= 0 for seconds in stats["timings"].values())
+    if "--workers" in options:
+        # Individual calls cannot be timed in worker processes
+        assert stats["slowest"] == []
+    else:
+        assert sum(stats["latency_histogram"].values()) == 2
+        assert sorted(item["value"] for item in stats["slowest"]) == [
+            "'5th October 2019 12:04'",
+            "'6th October 2019 00:05:06'",
+        ]
+
+
+def test_stats_json_multi(fresh_db_and_path, tmpdir):
+    db, db_path = fresh_db_and_path
+    db["creatures"].insert_all([{"name": "Simon"}, {"name": "Cleo"}])
+    stats_path = str(tmpdir / "stats.json")
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "creatures",
+            "name",
+            "--multi",
+            "--code",
+            '{"upper": value.upper()}',
+            "--stats-json",
+            stats_path,
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    stats = json.load(open(stats_path))
+    assert stats["values_scanned"] == 2
+    assert stats["fn_calls"] == 2
+
+
+def test_stats_json_written_on_error(test_db_and_path, tmpdir):
+    db, db_path = test_db_and_path
+    stats_path = str(tmpdir / "stats.json")
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "example",
+            "dt",
+            "--code",
+            "1 / 0",
+            "--batch-size",
+            "10",
+            "--stats-json",
+            stats_path,
+        ],
+    )
+    assert result.exit_code == 1
+    stats = json.load(open(stats_path))
+    assert stats["errors"] == 1
+    assert stats["fn_calls"] == 1
+
+
+def test_profile(test_db_and_path):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "example", "dt", "--profile", "--silent"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert "Values scanned: 4\n" in result.output
+    assert "Values skipped: 2\n" in result.output
+    assert "Function calls: 2 (2 changed, 0 errors)\n" in result.output
+    assert "Function call latency:\n" in result.output
+    assert "Slowest values:\n" in result.output
@@ -0,0 +1,76 @@
+from click.testing import CliRunner
+import json
+import pytest
+from sqlite_transform import cli
+
+
+def _json_lines(output):
+    return [json.loads(line) for line in output.splitlines() if line.startswith("{")]
+
+
+@pytest.mark.parametrize(
+    "options", ([], ["--batch-size", "3"], ["--dedupe"], ["--workers", "2"])
+)
+def test_progress_json(test_db_and_path, options):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "example", "dt", "--progress-json"] + options
+    )
+    assert 0 == result.exit_code, result.output
+    lines = _json_lines(result.output)
+    assert lines[-1]["done"]
+    assert lines[-1]["n"] == lines[-1]["total"] == 4
+    assert lines[-1]["desc"] is None
+    assert set(lines[-1]) == {"desc", "n", "total", "elapsed", "rate", "done"}
+
+
+def test_progress_json_multi(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["creatures"].insert_all([{"name": "Simon"}, {"name": "Cleo"}])
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "creatures",
+            "name",
+            "--multi",
+            "--code",
+            '{"upper": value.upper()}',
+            "--progress-json",
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [
+        (line["desc"], line["n"], line["done"])
+        for line in _json_lines(result.output)
+        if line["done"]
+    ] == [("1: Evaluating", 2, True), ("2: Updating", 2, True)]
+
+
+def test_progress_silent(test_db_and_path):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "example", "dt", "--progress-json", "-s"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert result.output == ""
+
+
+def test_progress_not_updated_per_value(fresh_db_and_path, monkeypatch):
+    db, db_path = fresh_db_and_path
+    db["example"].insert_all([{"id": i, "v": str(i)} for i in range(5000)], pk="id")
+    updates = []
+    update = cli.Progress.update
+
+    def counting_update(self, n):
+        updates.append(n)
+        return update(self, n)
+
+    monkeypatch.setattr(cli.Progress, "update", counting_update)
+    result = CliRunner().invoke(
+        cli.cli, ["lambda", db_path, "example", "v", "--code", "value + '!'"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert sum(updates) == 5000
+    assert len(updates) < 100
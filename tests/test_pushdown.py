@@ -0,0 +1,109 @@
+from click.testing import CliRunner
+from sqlite_transform import cli
+import json
+import pathlib
+import pytest
+import sqlite_utils
+
+VALUES = {
+    "parsedate": [
+        "2019-10-05",
+        "2019-10-05 12:30",
+        "2019-10-05T23:59:59",
+        "2020-02-29",
+        "5th October 2019",
+        "2019-10-05 12:30:00.5",
+        " 2019-10-05",
+        "",
+        None,
+    ],
+    "jsonsplit": ["a,b", " a , b ,", "a,,b", '"q",\\', "é,b", "x", "", None],
+}
+VALUES["parsedatetime"] = VALUES["parsedate"]
+# How many of those SQL can transform, the rest are empty or need Python
+IN_SQL = {"parsedate": 4, "parsedatetime": 4, "jsonsplit": 5}
+
+
+def _run(tmpdir, name, command, values, *options):
+    db_path = str(pathlib.Path(tmpdir) / "{}.db".format(name))
+    db = sqlite_utils.Database(db_path)
+    db["t"].insert_all(
+        [{"id": i, "v": value} for i, value in enumerate(values)], pk="id"
+    )
+    stats_path = str(pathlib.Path(tmpdir) / "{}.json".format(name))
+    result = CliRunner().invoke(
+        cli.cli,
+        [command, db_path, "t", "v", "--stats-json", stats_path] + list(options),
+    )
+    assert 0 == result.exit_code, result.output
+    return [row["v"] for row in db["t"].rows], json.load(open(stats_path))
+
+
+@pytest.mark.parametrize("command", ("parsedate", "parsedatetime", "jsonsplit"))
+def test_pushdown_matches_python(tmpdir, command):
+    expected, stats = _run(tmpdir, "python", command, VALUES[command])
+    assert stats["values_in_sql"] == 0
+    actual, stats = _run(
+        tmpdir, "sql", command, VALUES[command], "--sql-pushdown", "--no-dedupe"
+    )
+    assert actual == expected
+    assert stats["values_scanned"] == len(expected)
+    assert stats["values_in_sql"] == IN_SQL[command]
+    assert stats["fn_calls"] == len(expected) - IN_SQL[command] - 2
+
+
+def test_pushdown_jsonsplit_int(tmpdir):
+    values = ["1,2", " -3 , 007", "99999999999999999999,1", None]
+    options = ["--type", "int"]
+    expected, _ = _run(tmpdir, "python", "jsonsplit", values, *options)
+    actual, stats = _run(tmpdir, "sql", "jsonsplit", values, "--sql-pushdown", *options)
+    assert actual == expected
+    assert stats["values_in_sql"] == 2
+
+
+# sqlite3 reports the exception from the function as unraisable
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnraisableExceptionWarning")
+def test_pushdown_invalid_int_falls_back(tmpdir):
+    db_path = str(pathlib.Path(tmpdir) / "data.db")
+    sqlite_utils.Database(db_path)["t"].insert({"id": 1, "v": "1,x"}, pk="id")
+    result = CliRunner().invoke(
+        cli.cli, ["jsonsplit", db_path, "t", "v", "--type", "int", "--sql-pushdown"]
+    )
+    # Python raises the same error it always would for this value
+    assert result.exit_code == 1
+    assert "user-defined function raised exception" in str(result.exception)
+
+
+# sqlite3 reports the exception from the function as unraisable
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnraisableExceptionWarning")
+def test_pushdown_invalid_date_falls_back(tmpdir):
+    db_path = str(pathlib.Path(tmpdir) / "data.db")
+    sqlite_utils.Database(db_path)["t"].insert({"id": 1, "v": "2019-02-30"}, pk="id")
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "t", "v", "--sql-pushdown"]
+    )
+    assert result.exit_code == 1
+    assert "user-defined function raised exception" in str(result.exception)
+
+
+@pytest.mark.parametrize(
+    "options,error",
+    (
+        (["--dayfirst"], "--sql-pushdown cannot be used with --dayfirst or --format"),
+        (
+            ["--format", "%Y-%m-%d"],
+            "--sql-pushdown cannot be used with --dayfirst or --format",
+        ),
+        (
+            ["--batch-size", "10"],
+            "--sql-pushdown cannot be used with --dedupe, --batch-size or --workers",
+        ),
+    ),
+)
+def test_pushdown_errors(test_db_and_path, options, error):
+    _, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli, ["parsedate", db_path, "example", "dt", "--sql-pushdown"] + options
+    )
+    assert result.exit_code == 1
+    assert error in result.output
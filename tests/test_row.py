@@ -0,0 +1,166 @@
+from click.testing import CliRunner
+from sqlite_transform import cli
+import json
+import pytest
+
+
+@pytest.fixture
+def events_db_and_path(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["events"].insert_all(
+        [
+            {"id": 1, "date": "2021-01-02", "time": "10:30", "title": " One "},
+            {"id": 2, "date": "2021-02-03", "time": None, "title": "Two"},
+        ],
+        pk="id",
+    )
+    return db, db_path
+
+
+def test_row(events_db_and_path):
+    db, db_path = events_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "events",
+            "date",
+            "time",
+            "--row",
+            "--code",
+            "row['date'] + 'T' + (row['time'] or '00:00')",
+            "--output",
+            "starts",
+            "--drop",
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    assert list(db["events"].rows) == [
+        {"id": 1, "title": " One ", "starts": "2021-01-02T10:30"},
+        {"id": 2, "title": "Two", "starts": "2021-02-03T00:00"},
+    ]
+
+
+@pytest.mark.parametrize(
+    "options,expected_type",
+    (
+        ([], str),
+        (["--output-type", "integer"], int),
+        (["--output-type", "float"], float),
+    ),
+)
+def test_row_output_type(events_db_and_path, options, expected_type):
+    db, db_path = events_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "events", "date", "time", "--row", "--output", "month"]
+        + ["--code", "int(row['date'][5:7])"]
+        + options,
+    )
+    assert 0 == result.exit_code, result.output
+    assert db["events"].columns_dict["month"] is expected_type
+    assert [row["month"] for row in db["events"].rows] == [
+        expected_type(1),
+        expected_type(2),
+    ]
+
+
+def test_row_single_column(events_db_and_path):
+    db, db_path = events_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "events",
+            "title",
+            "--row",
+            "--code",
+            "row['title'].strip()",
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["title"] for row in db["events"].rows] == ["One", "Two"]
+
+
+def test_row_multi(events_db_and_path):
+    db, db_path = events_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "events",
+            "date",
+            "title",
+            "--row",
+            "--multi",
+            "--code",
+            "{'year': int(row['date'][:4]), 'title': row['title'].strip()}",
+            "--drop",
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    # title was written to, so isn't dropped
+    assert list(db["events"].rows) == [
+        {"id": 1, "time": "10:30", "title": "One", "year": 2021},
+        {"id": 2, "time": None, "title": "Two", "year": 2021},
+    ]
+
+
+def test_row_dry_run(events_db_and_path):
+    _, db_path = events_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "events", "date", "time", "--row", "--output", "starts"]
+        + ["--code", "row['date'] + ' ' + str(row['time'])", "--dry-run"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert result.output == (
+        "{'date': '2021-01-02', 'time': '10:30'}\n"
+        " --- becomes:\n"
+        "{'starts': '2021-01-02 10:30'}\n"
+        "\n"
+        "{'date': '2021-02-03', 'time': None}\n"
+        " --- becomes:\n"
+        "{'starts': '2021-02-03 None'}\n"
+        "\n"
+    )
+
+
+def test_row_errors_table(events_db_and_path):
+    db, db_path = events_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "events", "date", "time", "--row", "--output", "starts"]
+        + ["--code", "row['date'] + row['time']", "--errors-table", "errors"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["starts"] for row in db["events"].rows] == ["2021-01-0210:30", None]
+    error = next(db["errors"].rows)
+    assert error["key"] == 2
+    assert error["column"] == "date, time"
+    assert json.loads(error["value"]) == {"date": "2021-02-03", "time": None}
+
+
+@pytest.mark.parametrize(
+    "options,error",
+    (
+        ([], "--row needs --output when used with more than one column"),
+        (["--multi", "--output", "x"], "Cannot use --output with --row and --multi"),
+        (["--output", "x", "--batch"], "Cannot use --batch or --async with --row"),
+        (
+            ["--output", "x", "--workers", "2"],
+            "--row cannot be used with --batch-time, --workers, --dedupe",
+        ),
+    ),
+)
+def test_row_errors(events_db_and_path, options, error):
+    _, db_path = events_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "events", "date", "time", "--row", "--code", "1"] + options,
+    )
+    assert result.exit_code == 1
+    assert error in result.output
@@ -0,0 +1,111 @@
+from click.testing import CliRunner
+from sqlite_transform import cli
+import json
+import pathlib
+import pytest
+
+
+@pytest.fixture
+def dates_db_and_path(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["dates"].insert_all(
+        [
+            {"id": 1, "dt": "2019-10-05"},
+            {"id": 2, "dt": "6th October 2019"},
+            {"id": 3, "dt": ""},
+            {"id": 4, "dt": None},
+            {"id": 5, "dt": "2019-10-07"},
+        ],
+        pk="id",
+    )
+    # Count the rows that are actually written
+    db.execute("create table writes (id integer)")
+    db.execute(
+        "create trigger count_writes after update on dates "
+        "begin insert into writes values (new.id); end"
+    )
+    return db, db_path
+
+
+def _run(db_path, tmpdir, *options):
+    stats_path = str(pathlib.Path(tmpdir) / "stats.json")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["parsedate", db_path, "dates", "dt", "--stats-json", stats_path]
+        + list(options),
+    )
+    assert 0 == result.exit_code, result.output
+    return json.load(open(stats_path))
+
+
+@pytest.mark.parametrize(
+    "options",
+    (
+        ["--no-dedupe"],
+        ["--dedupe"],
+        ["--batch-size", "2"],
+        ["--workers", "2"],
+    ),
+)
+def test_unchanged_rows_not_written(dates_db_and_path, tmpdir, options):
+    db, db_path = dates_db_and_path
+    stats = _run(db_path, tmpdir, *options)
+    assert [row["dt"] for row in db["dates"].rows] == [
+        "2019-10-05",
+        "2019-10-06",
+        "",
+        None,
+        "2019-10-07",
+    ]
+    assert [row[0] for row in db.execute("select id from writes")] == [2]
+    assert stats["writes_skipped"] == 4
+
+
+@pytest.mark.parametrize(
+    "options", (["--no-dedupe"], ["--dedupe"], ["--batch-size", "2"])
+)
+def test_output_column_written_once(dates_db_and_path, tmpdir, options):
+    db, db_path = dates_db_and_path
+    options = list(options) + ["--output", "parsed"]
+    _run(db_path, tmpdir, *options)
+    assert [row["parsed"] for row in db["dates"].rows] == [
+        "2019-10-05",
+        "2019-10-06",
+        "",
+        None,
+        "2019-10-07",
+    ]
+    # Every row except the null one gets a new value in the output column
+    assert db.execute("select count(*) from writes").fetchone()[0] == 4
+    with db.conn:
+        db.execute("delete from writes")
+    stats = _run(db_path, tmpdir, *options)
+    assert db.execute("select count(*) from writes").fetchone()[0] == 0
+    assert stats["writes_skipped"] == 5
+
+
+def test_type_change_is_written(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    # No declared type, so values keep the type they were written with
+    db.execute("create table t (id integer primary key, v)")
+    db["t"].insert_all([{"id": 1, "v": 1}, {"id": 2, "v": 2}])
+    result = CliRunner().invoke(
+        cli.cli, ["lambda", db_path, "t", "v", "--code", "float(value)"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert db.execute("select typeof(v) from t").fetchall() == [("real",), ("real",)]
+
+
+def test_without_rowid_composite_key(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db.execute(
+        "create table t (a text, b text, v text, primary key (a, b)) without rowid"
+    )
+    db["t"].insert_all(
+        [{"a": "x", "b": "1", "v": "a,b"}, {"a": "x", "b": "2", "v": '["c"]'}]
+    )
+    result = CliRunner().invoke(
+        cli.cli, ["lambda", db_path, "t", "v", "--code", "value.upper()"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["v"] for row in db["t"].rows] == ["A,B", '["C"]']
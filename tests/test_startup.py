@@ -0,0 +1,82 @@
+import pytest
+import subprocess
+import sys
+
+# Only imported by the code that needs them, to keep startup fast
+HEAVY_MODULES = ("sqlite_utils", "dateutil", "tqdm", "asyncio", "multiprocessing")
+
+pytestmark = pytest.mark.skipif(
+    sys.version_info < (3, 7), reason="-X importtime needs Python 3.7 or later"
+)
+
+
+def _imported_modules(code):
+    # -X importtime writes a line to stderr for every module imported, which
+    # is more reliable to test against than how long the imports took
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return {
+        line.rsplit("|", 1)[-1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+
+@pytest.mark.parametrize(
+    "code,needed",
+    (
+        ("import sqlite_transform.cli", ()),
+        ("from sqlite_transform import Pipeline", ()),
+        (
+            "from sqlite_transform.cli import cli\n"
+            "try:\n"
+            "    cli(['lambda', '--help'])\n"
+            "except SystemExit:\n"
+            "    pass",
+            (),
+        ),
+        (
+            # A run against a single file, as from a shell loop, needs
+            # sqlite_utils, which imports dateutil itself
+            "import os, sqlite3, tempfile\n"
+            "path = os.path.join(tempfile.mkdtemp(), 'startup.db')\n"
+            "conn = sqlite3.connect(path)\n"
+            'conn.execute("create table t (v text)")\n'
+            "conn.execute(\"insert into t values ('a')\")\n"
+            "conn.commit()\n"
+            "from sqlite_transform.cli import cli\n"
+            "try:\n"
+            "    cli(['lambda', path, 't', 'v', '--code', 'value.upper()', '-s'])\n"
+            "except SystemExit as ex:\n"
+            "    assert not ex.code\n"
+            "assert conn.execute('select v from t').fetchone() == ('A',)",
+            ("sqlite_utils", "dateutil"),
+        ),
+    ),
+)
+def test_startup_does_not_import_heavy_modules(code, needed):
+    modules = _imported_modules(code)
+    assert "sqlite_transform.cli" in modules
+    assert (
+        sorted(
+            module
+            for module in modules
+            if module.split(".")[0] in HEAVY_MODULES
+            and module.split(".")[0] not in needed
+        )
+        == []
+    )
+
+
+def test_parsedate_imports_dateutil():
+    # Check the test above would notice the modules being imported
+    modules = _imported_modules(
+        "from sqlite_transform.cli import _parse_date\n"
+        "_parse_date('5th October 2019')"
+    )
+    assert "dateutil" in modules
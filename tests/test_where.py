@@ -0,0 +1,188 @@
+from click.testing import CliRunner
+import json
+import pytest
+from sqlite_transform import cli
+
+
+@pytest.mark.parametrize(
+    "options",
+    (
+        ["--no-dedupe"],
+        ["--dedupe"],
+        ["--batch-size", "1"],
+        ["--workers", "2"],
+    ),
+)
+def test_where(test_db_and_path, options):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "parsedate",
+            db_path,
+            "example",
+            "dt",
+            "--where",
+            "id > :min_id",
+            "-p",
+            "min_id",
+            "1",
+            "--output",
+            "parsed",
+        ]
+        + options,
+    )
+    assert 0 == result.exit_code, result.output
+    assert list(db["example"].rows) == [
+        {"id": 1, "dt": "5th October 2019 12:04", "parsed": None},
+        {"id": 2, "dt": "6th October 2019 00:05:06", "parsed": "2019-10-06"},
+        {"id": 3, "dt": "", "parsed": ""},
+        {"id": 4, "dt": None, "parsed": None},
+    ]
+
+
+@pytest.mark.parametrize("index", (False, True))
+def test_where_skips_excluded_rows(fresh_db_and_path, index):
+    db, db_path = fresh_db_and_path
+    db["example"].insert_all(
+        [{"id": i, "name": "x{}".format(i), "ok": i % 2} for i in range(1, 6)],
+        pk="id",
+    )
+    if index:
+        db["example"].create_index(["ok"])
+    # The code fails on x1, which --where excludes
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "example", "name", "--where", "ok = 0", "--code"]
+        + ["str(1/0) if value == 'x1' else value.upper()", "--no-dedupe"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["name"] for row in db["example"].rows] == [
+        "x1",
+        "X2",
+        "x3",
+        "X4",
+        "x5",
+    ]
+
+
+def test_where_batch_checkpoint_includes_where(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["example"].insert_all(
+        [{"id": i, "name": "name{}".format(i)} for i in range(1, 6)], pk="id"
+    )
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "example",
+            "name",
+            "--batch-size",
+            "1",
+            "--where",
+            "id % 2 = 1",
+            "--code",
+            "assert value != 'name5'\nreturn value.upper()",
+        ],
+    )
+    assert result.exit_code == 1
+    assert [r["name"] for r in db["example"].rows] == [
+        "NAME1",
+        "name2",
+        "NAME3",
+        "name4",
+        "name5",
+    ]
+    checkpoint = list(db[cli.PROGRESS_TABLE].rows)[0]
+    assert (checkpoint["last_key"], checkpoint["rows_done"]) == (3, 2)
+    job = json.loads(checkpoint["job"])
+    assert job[:3] + job[4:] == ["example", ["name"], None, "id % 2 = 1", {}]
+
+
+def test_where_multi(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["creatures"].insert_all(
+        [{"id": 1, "name": "Simon"}, {"id": 2, "name": "Cleo"}], pk="id"
+    )
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "creatures",
+            "name",
+            "--multi",
+            "--code",
+            '{"upper": value.upper()}',
+            "--where",
+            "name = :name",
+            "-p",
+            "name",
+            "Cleo",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert list(db["creatures"].rows) == [
+        {"id": 1, "name": "Simon", "upper": None},
+        {"id": 2, "name": "Cleo", "upper": "CLEO"},
+    ]
+
+
+def test_where_dry_run(test_db_and_path):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "example",
+            "dt",
+            "--code",
+            "value.upper()",
+            "--dry-run",
+            "--where",
+            "id = 2",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == (
+        "6th October 2019 00:05:06\n --- becomes:\n6TH OCTOBER 2019 00:05:06"
+    )
+
+
+def test_where_infer_date_formats(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["example"].insert_all(
+        [{"id": 1, "dt": "2019-10-05"}, {"id": 2, "dt": "10/05/2019"}], pk="id"
+    )
+    assert cli._infer_date_formats(
+        db_path, "example", ["dt"], False, False, "id = :id", {"id": 2}
+    ) == ("%m/%d/%Y",)
+
+
+def test_where_on_indexed_output(fresh_db_and_path, tmpdir):
+    # SQLite finds every matching row before updating any of them here, so
+    # results are worked out again rather than all being held in memory
+    db, db_path = fresh_db_and_path
+    stats_path = str(tmpdir / "stats.json")
+    db["example"].insert_all(
+        [{"id": i, "n": str(i), "half": None} for i in range(5)], pk="id"
+    )
+    db["example"].create_index(["half"])
+    result = CliRunner().invoke(
+        cli.cli,
+        ["lambda", db_path, "example", "n", "--output", "half", "--where"]
+        + ["half is null", "--code", "str(100 // int(value))", "--errors-table"]
+        + ["errors", "--no-dedupe", "--stats-json", stats_path],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["half"] for row in db["example"].rows] == [
+        None,
+        "100",
+        "50",
+        "33",
+        "25",
+    ]
+    assert [row["key"] for row in db["errors"].rows] == [0]
+    assert json.load(open(stats_path))["fn_calls"] > 5
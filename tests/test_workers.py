@@ -0,0 +1,108 @@
+from click.testing import CliRunner
+import json
+import pickle
+import pytest
+from sqlite_transform import cli
+
+
+@pytest.mark.parametrize("workers", (1, 3))
+def test_workers_lambda(test_db_and_path, workers):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "example",
+            "dt",
+            "--code",
+            "re.sub('O..', 'OXX', value)",
+            "--import",
+            "re",
+            "--workers",
+            str(workers),
+            "--batch-size",
+            "3",
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [
+        {"id": 1, "dt": "5th OXXober 2019 12:04"},
+        {"id": 2, "dt": "6th OXXober 2019 00:05:06"},
+        {"id": 3, "dt": ""},
+        {"id": 4, "dt": None},
+    ] == list(db["example"].rows)
+
+
+@pytest.mark.parametrize(
+    "command,expected",
+    (
+        ("parsedate", ["2019-10-05", "2019-10-06", "", None]),
+        ("parsedatetime", ["2019-10-05T12:04:00", "2019-10-06T00:05:06", "", None]),
+    ),
+)
+def test_workers_parsedate(test_db_and_path, command, expected):
+    db, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [command, db_path, "example", "dt", "--workers", "2", "--output", "parsed"],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [row["parsed"] for row in db["example"].rows] == expected
+
+
+def test_workers_jsonsplit(fresh_db_and_path):
+    db, db_path = fresh_db_and_path
+    db["example"].insert_all(
+        [{"id": i, "records": "{}; {}".format(i, i * 2)} for i in range(1, 21)],
+        pk="id",
+    )
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "jsonsplit",
+            db_path,
+            "example",
+            "records",
+            "--delimiter",
+            ";",
+            "--type",
+            "int",
+            "--workers",
+            "2",
+            "--batch-size",
+            "7",
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    assert [json.loads(row["records"]) for row in db["example"].rows] == [
+        [i, i * 2] for i in range(1, 21)
+    ]
+
+
+def test_compiled_code_can_be_pickled():
+    fn = cli.CompiledCode("textwrap.shorten(value, 12)", ["textwrap"])
+    unpickled = pickle.loads(pickle.dumps(fn))
+    assert unpickled("hello there world") == "hello [...]"
+    assert unpickled.code == "textwrap.shorten(value, 12)"
+    assert unpickled.imports == ("textwrap",)
+
+
+def test_workers_cannot_be_used_with_multi(test_db_and_path):
+    _, db_path = test_db_and_path
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "lambda",
+            db_path,
+            "example",
+            "dt",
+            "--code",
+            "{}",
+            "--multi",
+            "--workers",
+            "2",
+        ],
+    )
+    assert result.exit_code == 1
+    assert "--multi cannot be used with --batch-time, --workers" in result.output